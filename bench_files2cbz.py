@@ -0,0 +1,285 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+from datetime import datetime
+from typing import Dict, List
+
+from PIL import Image, ImageDraw
+
+files2cbz_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "files2cbz.py")
+
+
+def arg_parser() -> argparse.Namespace:
+    """Parser function to get all the arguments
+
+    Returns:
+        Argument parser
+    """
+    description = "Benchmark files2cbz.py on synthetic comics"
+
+    # Construct the argument parse and parse the arguments
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=description
+    )
+    parser.add_argument("--books", type=int, default=4, help="Number of books per package type")
+    parser.add_argument("--pages", type=int, default=40, help="Number of pages per book")
+    parser.add_argument(
+        "--resolution", type=int, nargs=2, default=[1200, 1800], help="Page resolution, e.g. 1200 1800"
+    )
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["RGB", "RGBA", "P", "CMYK"],
+        default=["RGB", "RGBA", "P", "CMYK"],
+        help="Image modes the pages cycle through",
+    )
+    parser.add_argument("--nesting", type=int, default=1, help="Folder depth of the pages inside a book")
+    parser.add_argument(
+        "--packages",
+        nargs="+",
+        choices=["folder", "cbz", "pdf"],
+        default=["folder", "cbz", "pdf"],
+        help="How the books are packaged",
+    )
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4], help="--threads settings to run")
+    parser.add_argument(
+        "--page-workers", type=int, nargs="+", default=[1], help="--page-workers settings to run"
+    )
+    parser.add_argument("--stream", action="store_true", help="Also run every setting with --stream")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs per setting")
+    parser.add_argument("-o", "--output", type=str, default="bench_files2cbz.json", help="Results file")
+    parser.add_argument("--work-dir", type=str, default=None, help="Folder for the generated books")
+
+    print("\n" + str(parser.parse_args()) + "\n")
+
+    return parser.parse_args()
+
+
+def make_page(mode: str, size: List[int], number: int) -> Image.Image:
+    """Draw a synthetic comic page
+
+    Args:
+        mode: image mode, RGB, RGBA, P or CMYK.
+        size: (width, height) of the page.
+        number: page number, drawn on the page and used to vary it.
+
+    Returns:
+        Page image.
+    """
+    width, height = size
+    im = Image.new("RGB", (width, height), (250, 250, 245))
+    draw = ImageDraw.Draw(im)
+
+    # A 2x3 grid of panels with some shading, so pages don't compress to nothing.
+    for row, column in itertools.product(range(3), range(2)):
+        left, top = column * width // 2 + 10, row * height // 3 + 10
+        right, bottom = (column + 1) * width // 2 - 10, (row + 1) * height // 3 - 10
+        shade = (number * 37 + row * 53 + column * 91) % 200
+        draw.rectangle((left, top, right, bottom), fill=(shade, 255 - shade, (shade * 3) % 255), outline=0, width=4)
+        for line in range(top, bottom, 12):
+            draw.line((left, line, right, line + (line % 40)), fill=(shade // 2, shade // 3, shade), width=1)
+    draw.text((20, 20), "Page %d" % number, fill=(0, 0, 0))
+
+    if mode == "RGBA":
+        im.putalpha(220)
+    elif mode == "P":
+        im = im.convert("P", palette=Image.Palette.ADAPTIVE)
+    elif mode == "CMYK":
+        im = im.convert("CMYK")
+    return im
+
+
+def page_file(mode: str) -> str:
+    """File extension pages of a mode are stored with
+
+    Args:
+        mode: image mode.
+
+    Returns:
+        File extension.
+    """
+    return ".jpg" if mode in ("RGB", "CMYK") else ".png"
+
+
+def generate_book(arguments: argparse.Namespace, folder: str) -> List[str]:
+    """Generate a book as a folder of pages
+
+    Args:
+        arguments: argument parser.
+        folder: folder to create the pages in.
+
+    Returns:
+        Paths of the pages in reading order.
+    """
+    pages = []
+    for number in range(1, arguments.pages + 1):
+        # Split pages over nested chapter folders.
+        page_folder = folder
+        for depth in range(arguments.nesting):
+            page_folder = os.path.join(page_folder, "Chapter %d" % ((number - 1) // 10 + 1 + depth))
+        os.makedirs(page_folder, exist_ok=True)
+
+        mode = arguments.modes[(number - 1) % len(arguments.modes)]
+        path = os.path.join(page_folder, "page %d%s" % (number, page_file(mode)))
+        make_page(mode, arguments.resolution, number).save(path)
+        pages.append(path)
+    return pages
+
+
+def generate_library(arguments: argparse.Namespace, folder: str) -> Dict[str, List[str]]:
+    """Generate all books for all package types
+
+    Args:
+        arguments: argument parser.
+        folder: folder to create the library in.
+
+    Returns:
+        Book paths by package type.
+    """
+    library = {package: [] for package in arguments.packages}
+    for book in range(1, arguments.books + 1):
+        book_folder = os.path.join(folder, "folder", "Book %d" % book)
+        pages = generate_book(arguments, book_folder)
+
+        if "folder" in library:
+            library["folder"].append(book_folder)
+
+        if "cbz" in library:
+            os.makedirs(os.path.join(folder, "cbz"), exist_ok=True)
+            cbz = os.path.join(folder, "cbz", "Book %d.cbz" % book)
+            with zipfile.ZipFile(cbz, "w") as zip_obj:
+                for page in pages:
+                    zip_obj.write(page, os.path.relpath(page, book_folder))
+            library["cbz"].append(cbz)
+
+        # PDF pages are stored as embedded JPEGs, like scanned comics.
+        if "pdf" in library:
+            os.makedirs(os.path.join(folder, "pdf"), exist_ok=True)
+            pdf = os.path.join(folder, "pdf", "Book %d.pdf" % book)
+            images = [Image.open(page).convert("RGB") for page in pages]
+            images[0].save(pdf, save_all=True, append_images=images[1:], resolution=150)
+            for im in images:
+                im.close()
+            library["pdf"].append(pdf)
+
+    # Only keep the book folders when they are benchmarked themselves.
+    if "folder" not in library:
+        shutil.rmtree(os.path.join(folder, "folder"))
+    return library
+
+
+def run_setting(arguments: argparse.Namespace, inputs: List[str], options: List[str], run_dir: str) -> Dict:
+    """Run files2cbz.py once on fresh copies of the inputs
+
+    Args:
+        arguments: argument parser.
+        inputs: book paths.
+        options: files2cbz.py options of this setting.
+        run_dir: empty folder to copy the books to.
+
+    Returns:
+        Summary of the files2cbz.py metrics report.
+    """
+    # CBZ inputs are replaced by their output, so every run works on copies.
+    copies = []
+    for item in inputs:
+        copy = os.path.join(run_dir, os.path.basename(item))
+        if os.path.isdir(item):
+            shutil.copytree(item, copy)
+        else:
+            shutil.copyfile(item, copy)
+        copies.append(copy)
+
+    metrics_path = os.path.join(run_dir, "metrics.json")
+    command = [sys.executable, files2cbz_path, "-i", ",".join(copies), "--silence", "--metrics", metrics_path]
+    subprocess.run(command + options, check=True, stdout=subprocess.DEVNULL, cwd=run_dir)
+
+    with open(metrics_path, "r", encoding="utf-8") as f:
+        return json.load(f)["summary"]
+
+
+def benchmark(arguments: argparse.Namespace, work_dir: str) -> Dict:
+    """Generate the library and run every setting on every package type
+
+    Args:
+        arguments: argument parser.
+        work_dir: folder for the generated books and the runs.
+
+    Returns:
+        Results with the benchmark parameters and one entry per run.
+    """
+    print("Generating %d books of %d pages..." % (arguments.books * len(arguments.packages), arguments.pages))
+    library = generate_library(arguments, os.path.join(work_dir, "library"))
+
+    streams = [False, True] if arguments.stream else [False]
+    runs = []
+    for package, threads, page_workers, stream in itertools.product(
+        arguments.packages, arguments.threads, arguments.page_workers, streams
+    ):
+        options = ["--threads", str(threads), "--page-workers", str(page_workers)]
+        if stream:
+            options.append("--stream")
+
+        for repeat in range(arguments.repeat):
+            run_dir = tempfile.mkdtemp(prefix="run_", dir=work_dir)
+            summary = run_setting(arguments, library[package], options, run_dir)
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+            run = {
+                "package": package,
+                "threads": threads,
+                "page_workers": page_workers,
+                "stream": stream,
+                "repeat": repeat,
+                "wall_time": summary["wall_time"],
+                "pages": summary["pages"],
+                "pages_per_sec": summary["pages_per_sec"],
+                "bytes_in": summary["bytes_in"],
+                "bytes_out": summary["bytes_out"],
+                "peak_rss": summary["peak_rss"],
+                "stages": summary["stages"],
+                "failed": summary["failed"],
+            }
+            runs.append(run)
+            print(
+                "%-6s threads=%-2d page-workers=%-2d stream=%-5s %8.1f pages/sec  peak RSS %s"
+                % (package, threads, page_workers, stream, run["pages_per_sec"], run["peak_rss"])
+            )
+
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "parameters": {
+            "books": arguments.books,
+            "pages": arguments.pages,
+            "resolution": arguments.resolution,
+            "modes": arguments.modes,
+            "nesting": arguments.nesting,
+        },
+        "runs": runs,
+    }
+
+
+if __name__ == "__main__":
+
+    args = arg_parser()
+
+    # Generated books are removed afterwards unless a work dir is given.
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = benchmark(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = benchmark(args, temp_dir)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print("Results written to %s" % args.output)
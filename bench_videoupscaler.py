@@ -0,0 +1,270 @@
+import argparse
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Tuple
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+import videoupscaler
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def size_type(value: str) -> Tuple[int, int]:
+    """Argument type for sizes written as WIDTHxHEIGHT
+
+    Args:
+        value: size, e.g. 1280x720.
+
+    Returns:
+        (width, height).
+    """
+    try:
+        width, height = value.lower().split("x")
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError("%s is not a size like 1280x720" % value)
+
+
+def arg_parser() -> argparse.Namespace:
+    """Parser function to get all the arguments
+
+    Returns:
+        Argument parser
+    """
+    description = "Benchmark videoupscaler.py on synthetic clips, without ffmpeg"
+
+    # Construct the argument parse and parse the arguments
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter, description=description
+    )
+    parser.add_argument(
+        "--sources", type=size_type, nargs="+", default=[(640, 360), (1280, 720)], help="Clip resolutions"
+    )
+    parser.add_argument("--lengths", type=int, nargs="+", default=[120], help="Clip lengths in frames")
+    parser.add_argument("--target", type=size_type, default=(1920, 1080), help="Resolution clips are scaled to")
+    parser.add_argument(
+        "--interps",
+        nargs="+",
+        choices=["fast", "balanced", "quality", "auto"],
+        default=["fast", "balanced", "quality", "auto"],
+        help="--interp settings to run",
+    )
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="--workers settings to run")
+    parser.add_argument("--queue-size", type=int, default=16, help="--queue-size of every run")
+    parser.add_argument("--dedup", action="store_true", help="Also run every setting with --dedup")
+    parser.add_argument(
+        "--static", type=float, default=0.0, help="Share of the clip frames that repeat the previous frame"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs per setting")
+    parser.add_argument("-o", "--output", type=str, default="bench_videoupscaler.json", help="Results file")
+    parser.add_argument("--work-dir", type=str, default=None, help="Folder for the generated clips")
+
+    print("\n" + str(parser.parse_args()) + "\n")
+
+    return parser.parse_args()
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process
+
+    Returns:
+        Peak RSS in bytes, or None where the resource module is missing.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def make_clip(path: str, size: Tuple[int, int], length: int, static: float) -> None:
+    """Write a synthetic clip with OpenCV's built-in MJPEG encoder
+
+    A gradient scrolls under a moving box and a frame counter, so frames
+    differ and don't compress to nothing.
+
+    Args:
+        path: .avi file to write.
+        size: (width, height) of the clip.
+        length: number of frames.
+        static: share of the frames that repeat the previous frame.
+
+    Returns:
+        None.
+    """
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 25, size)
+    if not writer.isOpened():
+        raise RuntimeError("OpenCV can't write MJPEG to %s" % path)
+
+    gradient = np.add.outer(np.arange(height), np.arange(width)).astype(np.uint8)
+    frame = None
+    changes = 0
+    for number in range(length):
+        # Repeat the previous frame for the static share of the clip.
+        if frame is not None and number - changes + 1 <= static * (number + 1):
+            writer.write(frame)
+            continue
+        changes += 1
+
+        shift = (changes * 4) % width
+        frame = cv2.merge([np.roll(gradient, shift, axis=1), np.roll(gradient, shift // 2, axis=0), gradient])
+        left = (changes * 8) % max(1, width - width // 4)
+        cv2.rectangle(frame, (left, height // 3), (left + width // 4, 2 * height // 3), (30, 200, 240), -1)
+        cv2.putText(frame, "Frame %d" % number, (20, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        writer.write(frame)
+    writer.release()
+
+
+def run_setting(clip: str, output: str, target: Tuple[int, int], interp: str, workers: int, queue_size: int,
+                dedup: bool) -> Dict:
+    """Scale a clip once with the videoupscaler.py pipeline, run in a fresh process
+
+    The scaled frames go to OpenCV's MJPEG encoder instead of H.264, so no
+    ffmpeg is needed. Encode numbers are for MJPEG.
+
+    Args:
+        clip: source clip.
+        output: scaled clip to write.
+        target: (width, height) to scale to.
+        interp: --interp setting.
+        workers: number of resize workers.
+        queue_size: frames each pipeline queue holds.
+        dedup: skip resizing unchanged frames.
+
+    Returns:
+        Wall time, frame counts, per-stage timing and peak RSS of the run.
+    """
+    source_video = cv2.VideoCapture(clip)
+    source_size = (int(source_video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(source_video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    plan = videoupscaler.resize_plan(source_size, target, "stretch", interp)
+    scaled_video = cv2.VideoWriter(output, cv2.VideoWriter_fourcc(*"MJPG"), source_video.get(cv2.CAP_PROP_FPS),
+                                   plan[1])
+    timings = {"decode": [], "resize": [], "encode": []}
+
+    start = time.perf_counter()
+    frames, duplicates = videoupscaler.run_pipeline(
+        source_video, scaled_video, plan, workers, queue_size, tqdm(disable=True), timings, 0 if dedup else None
+    )
+    wall_time = time.perf_counter() - start
+    source_video.release()
+    scaled_video.release()
+
+    stages = {}
+    for stage, times in timings.items():
+        mean = sum(times) / len(times) if times else 0
+        stages[stage] = {
+            "frames": len(times),
+            "mean_ms": mean * 1000,
+            "fps": 1 / mean if mean else None,
+        }
+    return {
+        "wall_time": wall_time,
+        "frames": frames,
+        "duplicates": duplicates,
+        "fps": frames / wall_time if wall_time else None,
+        "stages": stages,
+        "peak_rss": peak_rss(),
+    }
+
+
+def benchmark(arguments: argparse.Namespace, work_dir: str) -> Dict:
+    """Generate the clips and run every setting on every clip
+
+    Args:
+        arguments: argument parser.
+        work_dir: folder for the generated clips and the runs.
+
+    Returns:
+        Results with the benchmark parameters and one entry per run.
+    """
+    clips = {}
+    for size, length in itertools.product(arguments.sources, arguments.lengths):
+        path = os.path.join(work_dir, "clip_%dx%d_%d.avi" % (size[0], size[1], length))
+        print("Generating %s..." % os.path.basename(path))
+        make_clip(path, size, length, arguments.static)
+        clips[(size, length)] = path
+
+    # Every run gets a fresh process, so peak RSS is its own.
+    context = multiprocessing.get_context("spawn")
+    dedups = [False, True] if arguments.dedup else [False]
+    runs = []
+    for (size, length), interp, workers, dedup in itertools.product(
+        clips, arguments.interps, arguments.workers, dedups
+    ):
+        for repeat in range(arguments.repeat):
+            output = os.path.join(work_dir, "scaled.avi")
+            with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+                result = executor.submit(
+                    run_setting, clips[(size, length)], output, arguments.target, interp, workers,
+                    arguments.queue_size, dedup
+                ).result()
+            os.remove(output)
+
+            run = {
+                "source": list(size),
+                "length": length,
+                "interp": interp,
+                "workers": workers,
+                "dedup": dedup,
+                "repeat": repeat,
+            }
+            run.update(result)
+            runs.append(run)
+            print(
+                "%4dx%-4d %5d frames interp=%-8s workers=%-2d dedup=%-5s %7.1f fps  "
+                "decode %7.1f  resize %7.1f  encode %7.1f fps  peak RSS %s"
+                % (size[0], size[1], length, interp, workers, dedup, run["fps"] or 0,
+                   run["stages"]["decode"]["fps"] or 0, run["stages"]["resize"]["fps"] or 0,
+                   run["stages"]["encode"]["fps"] or 0, run["peak_rss"])
+            )
+
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "parameters": {
+            "sources": [list(size) for size in arguments.sources],
+            "lengths": arguments.lengths,
+            "target": list(arguments.target),
+            "queue_size": arguments.queue_size,
+            "static": arguments.static,
+        },
+        "runs": runs,
+    }
+
+
+if __name__ == "__main__":
+
+    args = arg_parser()
+
+    # Generated clips are removed afterwards unless a work dir is given.
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = benchmark(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = benchmark(args, temp_dir)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print("Results written to %s" % args.output)
@@ -1,20 +1,61 @@
 import argparse
+import asyncio
+import collections
 import concurrent.futures
+import contextlib
+import hashlib
+import io
+import itertools
+import json
 import os
+import queue
 import re
 import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
 from datetime import datetime
 from os.path import basename
 from shutil import copyfile
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import natsort
 import patoolib
+import PyPDF2
 from pdf2jpg import pdf2jpg
 from PIL import Image
+from tqdm import tqdm
+
+try:
+    import rarfile
+except ImportError:  # CBR files are then always extracted to disk with patool.
+    rarfile = None
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is then left out of the metrics.
+    resource = None
 
 Image.MAX_IMAGE_PIXELS = None  # disables the warning
 
+# Image modes readers handle, everything else (alpha, palette, CMYK, ...) is converted to RGB.
+reader_safe_modes = ("RGB", "L")
+
+# Name of the manifest kept in each output folder by --incremental, and the options it records.
+manifest_name = ".files2cbz.json"
+watch_state_name = ".files2cbz-watch.json"
+manifest_options = ("dontrename", "reencode", "dpi", "max_height", "quality", "format")
+
+# File extensions of the --format choices.
+format_exts = {"jpeg": ".jpg", "webp": ".webp"}
+manifest_lock = threading.Lock()
+
+# Content stream operators of a PDF page that only draws an image.
+image_only_operators = (b"q", b"Q", b"cm", b"Do", b"gs")
+
 default_output_folder = datetime.now().strftime("%Y%m%d_%H%M%S")
 fullOutputPath = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), default_output_folder
@@ -59,12 +100,109 @@ def parser() -> argparse.Namespace:
         action="store_true",
         help="Instead of using multiple inputs just use all sub folders in folder (creating multiple cbz files)",
     )
+    arguments.add_argument(
+        "--stream",
+        action="store_true",
+        help="Convert CBZ, CBR and folder inputs straight into the output CBZ without temporary folders",
+    )
+    arguments.add_argument(
+        "--dpi",
+        type=int,
+        default=300,
+        help="Resolution for PDF pages that have to be rasterized",
+    )
+    arguments.add_argument(
+        "--max-height",
+        type=int,
+        default=None,
+        help="Shrink pages higher than this many pixels, keeping the aspect ratio",
+    )
+    arguments.add_argument(
+        "--quality",
+        type=int,
+        default=None,
+        help="Re-encode every page with this JPEG/WebP quality (1-100)",
+    )
+    arguments.add_argument(
+        "--format",
+        choices=sorted(format_exts),
+        default=None,
+        help="Store all pages in this format instead of keeping their own",
+    )
+    arguments.add_argument(
+        "--reencode",
+        action="store_true",
+        help="Re-encode every page, also pages that already are RGB or grayscale",
+    )
+    arguments.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Skip inputs whose CBZ is up to date according to the manifest in the output folder",
+    )
+    arguments.add_argument(
+        "--hash",
+        action="store_true",
+        help="Compare input content hashes instead of size and modification time with --incremental",
+    )
+    arguments.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print how the pages of each input would be named",
+    )
+    arguments.add_argument(
+        "--metrics",
+        type=str,
+        default=None,
+        help="Write per-input stage timings, sizes and throughput to this JSON file",
+    )
+    arguments.add_argument(
+        "--watch",
+        type=str,
+        default=None,
+        help="Keep running and convert CBR, CBZ, PDF and folders dropped in this folder",
+    )
+    arguments.add_argument(
+        "--settle",
+        type=float,
+        default=5.0,
+        help="Seconds a drop must stay unchanged before --watch converts it",
+    )
+    arguments.add_argument(
+        "--poll",
+        type=float,
+        default=1.0,
+        help="Seconds between scans of the --watch folder",
+    )
     arguments.add_argument(
         "--threads",
         type=int,
         default=1,
         help="Number of threads to use for processing",
     )
+    arguments.add_argument(
+        "--max-inflight",
+        type=int,
+        default=None,
+        help="Maximum number of inputs processed at once (defaults to --threads)",
+    )
+    arguments.add_argument(
+        "--max-temp-bytes",
+        type=int,
+        default=None,
+        help="Temporary disk space budget in bytes for the inputs processed at once",
+    )
+    arguments.add_argument(
+        "--temp-dir",
+        type=str,
+        default=None,
+        help="Folder for the temporary folders of the inputs (defaults to the system temp folder)",
+    )
+    arguments.add_argument(
+        "--page-workers",
+        type=int,
+        default=1,
+        help="Number of processes converting pages within one input (0 uses all cores)",
+    )
 
     print("\n" + str(arguments.parse_args()) + "\n")
 
@@ -99,31 +237,672 @@ def extract_cbz(filename: str, temp_dir_name: str) -> None:
     zip_file.close()
 
 
-def extract_pdf(filename: str, temp_dir_name: str) -> None:
+def page_jpeg(page: PyPDF2.PageObject) -> Optional[bytes]:
+    """Get the embedded JPEG of a PDF page consisting of a single image
+
+    Args:
+        page: PDF page.
+
+    Returns:
+        The JPEG stream as stored in the PDF, or None if the page has anything else on it.
+    """
+    resources = page.get("/Resources")
+    if resources is None:
+        return None
+    resources = resources.get_object()
+    if "/Font" in resources or "/XObject" not in resources:
+        return None
+
+    x_objects = resources["/XObject"].get_object()
+    if len(x_objects) != 1:
+        return None
+    image = list(x_objects.values())[0].get_object()
+    if image.get("/Subtype") != "/Image" or "/SMask" in image or "/Decode" in image:
+        return None
+    filters = image.get("/Filter")
+    if filters not in ("/DCTDecode", ["/DCTDecode"]):
+        return None
+
+    # A rotated page would come out in another orientation than rasterized, /Rotate can be inherited.
+    node = page
+    while node is not None and "/Rotate" not in node:
+        node = node.get("/Parent")
+        node = node.get_object() if node is not None else None
+    if node is not None and int(node["/Rotate"]) % 360:
+        return None
+
+    # Anything but drawing the image (text, paths, shadings) means vector content.
+    contents = page.get_contents()
+    if contents is None:
+        return None
+    ctm = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+    stack = []
+    drawn = 0
+    for operands, operator in PyPDF2.generic.ContentStream(contents, page.pdf).operations:
+        if operator not in image_only_operators:
+            return None
+        if operator == b"q":
+            stack.append(ctm)
+        elif operator == b"Q" and stack:
+            ctm = stack.pop()
+        elif operator == b"cm":
+            a, b, c, d, e, f = (float(operand) for operand in operands)
+            ctm = (a * ctm[0] + b * ctm[2], a * ctm[1] + b * ctm[3],
+                   c * ctm[0] + d * ctm[2], c * ctm[1] + d * ctm[3],
+                   e * ctm[0] + f * ctm[2] + ctm[4], e * ctm[1] + f * ctm[3] + ctm[5])
+        elif operator == b"Do":
+            drawn += 1
+            # Only an upright, unflipped image that lies inside the visible page is the page as is.
+            a, b, c, d, e, f = ctm
+            box = page.cropbox
+            if (
+                drawn > 1 or b or c or a <= 0 or d <= 0
+                or e < float(box.left) - 1 or f < float(box.bottom) - 1
+                or e + a > float(box.right) + 1 or f + d > float(box.top) + 1
+            ):
+                return None
+
+    return image.get_data() if drawn else None
+
+
+def extract_pdf(filename: str, temp_dir_name: str, dpi: int = 300, workers: int = 1) -> None:
     """Extract PDF file
 
+    Pages made of a single embedded JPEG are copied out as is, the rest are
+    rasterized with pdf2jpg, split over a number of parallel runs.
+
     Args:
         filename: input file name.
         temp_dir_name: temporary directory name.
+        dpi: resolution of rasterized pages.
+        workers: number of parallel pdf2jpg runs.
 
     Returns:
         None
     """
-    data = pdf2jpg.convert_pdf2jpg(filename, temp_dir_name, dpi=300, pages="ALL")
-    if not data:
-        print(
-            "WIN ERROR 2 ? - You will probably have to install JAVA and restart terminal or system"
-        )
+    # Same layout as pdf2jpg, <temp_dir_name>/<pdf name>_dir/<page>_<pdf name>.jpg
+    pdf_name = os.path.basename(filename)
+    pdf_dir = os.path.join(temp_dir_name, pdf_name + "_dir")
+    os.makedirs(pdf_dir, exist_ok=True)
+
+    raster_pages = []
+    reader = PyPDF2.PdfReader(filename)
+    for page_number, page in enumerate(reader.pages):
+        data = page_jpeg(page)
+        if data is None:
+            raster_pages.append(str(page_number))
+            continue
+        with open(os.path.join(pdf_dir, "%d_%s.jpg" % (page_number, pdf_name)), "wb") as f:
+            f.write(data)
+
+    if not raster_pages:
+        return
+    print(f"Rasterizing {len(raster_pages)} of {len(reader.pages)} pages at {dpi} dpi...")
+
+    # pdf2jpg clears its output folder, so every run gets its own.
+    workers = max(1, min(workers, len(raster_pages)))
+    chunks = [raster_pages[i::workers] for i in range(workers)]
+
+    def rasterize(chunk_index: int) -> None:
+        chunk_dir = os.path.join(temp_dir_name, "raster_%d" % chunk_index)
+        data = pdf2jpg.convert_pdf2jpg(filename, chunk_dir, dpi=dpi, pages=",".join(chunks[chunk_index]))
+        if not data:
+            raise RuntimeError(
+                "pdf2jpg failed on %s - You will probably have to install JAVA and restart terminal or system"
+                % filename
+            )
+        for file in data[0]["output_jpgfiles"]:
+            shutil.move(file, os.path.join(pdf_dir, os.path.basename(file)))
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        list(executor.map(rasterize, range(workers)))
+
+
+@contextlib.contextmanager
+def timed(metrics: Optional[Dict], stage: str) -> Iterator[None]:
+    """Add the wall time of a block to a stage of the metrics
+
+    Args:
+        metrics: metrics of the input, None to not measure anything.
+        stage: stage name, like extract, plan, convert, zip or cleanup.
+
+    Returns:
+        Context manager.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if metrics is not None:
+            metrics["stages"][stage] = metrics["stages"].get(stage, 0.0) + time.perf_counter() - start
+
+
+def peak_rss() -> Optional[int]:
+    """Peak resident set size of the whole run
+
+    The larger of this process and its biggest finished page worker. It is
+    a high-water mark for the run, not for one input, so it is only
+    reported in the run summary.
+
+    Returns:
+        Peak RSS in bytes, None where the resource module is missing.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return scale * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def cbz_path(inputs: str) -> str:
+    """Determine the output CBZ path for an input
+
+    Args:
+        inputs: input file or folder.
+
+    Returns:
+        Path of the CBZ file, placed next to the input.
+    """
+    out_file_name = os.path.splitext(inputs.split(os.sep)[-1])[0]
+    input_file_path = inputs.replace(inputs.split(os.sep)[-1], "")
+    return os.path.join(input_file_path, out_file_name) + ".cbz"
+
+
+def page_name(arguments: argparse.Namespace, last_dir: Optional[str], file: str) -> str:
+    """Determine the new name of a page
+
+    Args:
+        arguments: argument parser.
+        last_dir: name of the folder containing the page, None if it is in the root.
+        file: file name of the page.
+
+    Returns:
+        New file name including extension.
+    """
+    # Get file extension, or the one of the chosen format
+    file_ext = format_exts[arguments.format] if arguments.format else os.path.splitext(file)[-1]
+
+    # Rename images is chosen (cbz don't like 1.jpg and 10.jpg so zeroes should be added).
+    if arguments.dontrename:
+        file_name = os.path.splitext(file)[0]
+    else:
+        if last_dir is None:
+            # If 'last_dir' is None, extract digits from 'file' and format
+            # 'file_name' with leading zeros as a 4-digit number
+            file_digits = re.search(r"\d+", file)
+            file_name = "%04d" % (
+                int(file_digits.group()) if file_digits else 0
+            )
+        else:
+            # If 'last_dir' is not None, extract digits from 'last_dir' and 'file'
+            # then format 'file_name' as a 3-digit number concatenated with a 4-digit number
+            last_dir_digits = re.search(r"\d+", last_dir)
+            file_digits = re.search(r"\d+", file)
+
+            last_dir_number = (
+                int(last_dir_digits.group()) if last_dir_digits else 0
+            )
+            file_number = int(file_digits.group()) if file_digits else 0
+
+            file_name = "%03d%04d" % (last_dir_number, file_number)
+
+    return file_name + file_ext
+
+
+def is_reader_safe(im: Image.Image, file_ext: str) -> bool:
+    """Check if an opened page can be stored as is
+
+    Only the header is looked at, Image.open() doesn't decode the pixels.
+
+    Args:
+        im: opened image.
+        file_ext: file extension of the page.
+
+    Returns:
+        True if the page is RGB or grayscale without transparency, not a progressive JPEG, and its format
+        matches the extension.
+    """
+    return (
+        im.format == Image.registered_extensions().get(file_ext.lower())
+        and im.mode in reader_safe_modes
+        and "transparency" not in im.info
+        and not (im.format == "JPEG" and im.info.get("progressive"))
+    )
+
+
+def convert_options(arguments: argparse.Namespace) -> Dict:
+    """Collect the options page conversion needs
+
+    Args:
+        arguments: argument parser.
+
+    Returns:
+        Picklable options for convert_page() and convert_file().
+    """
+    return {
+        "reencode": arguments.reencode or arguments.quality is not None,
+        "max_height": arguments.max_height,
+        "quality": arguments.quality,
+    }
+
+
+def needs_conversion(im: Image.Image, file_ext: str, options: Dict) -> bool:
+    """Check if an opened page has to be re-encoded
+
+    Args:
+        im: opened image.
+        file_ext: file extension of the new page.
+        options: conversion options.
+
+    Returns:
+        True if the page is not reader-safe, too high or re-encoding is forced.
+    """
+    return (
+        options["reencode"]
+        or not is_reader_safe(im, file_ext)
+        or (options["max_height"] is not None and im.height > options["max_height"])
+    )
+
+
+def encode_page(im: Image.Image, file_ext: str, options: Dict, fp) -> None:
+    """Convert an opened page to RGB, shrink it to the maximum height and save it
+
+    JPEG pages are decoded at a reduced scale (draft mode) when they are
+    shrunk, so large scans are never fully decoded.
+
+    Args:
+        im: opened image.
+        file_ext: file extension of the new page, used to pick the output format.
+        options: conversion options.
+        fp: file name or file object to save to.
+
+    Returns:
+        None.
+    """
+    max_height = options["max_height"]
+    if max_height is not None and im.height > max_height:
+        size = (max(1, round(im.width * max_height / im.height)), max_height)
+        im.draft("RGB", size)
+        im = im.convert("RGB")
+        if im.size != size:
+            im = im.resize(size, Image.Resampling.LANCZOS)
+    else:
+        im = im.convert("RGB")
+
+    save_options = {}
+    if options["quality"] is not None:
+        save_options["quality"] = options["quality"]
+    im.save(fp, format=Image.registered_extensions().get(file_ext.lower()), **save_options)
+
+
+def convert_page(data: bytes, file_ext: str, options: Dict) -> bytes:
+    """Convert a page to RGB in memory
+
+    Pages which are already reader-safe are returned byte-for-byte.
+
+    Args:
+        data: encoded image.
+        file_ext: file extension of the new page, used to pick the output format.
+        options: conversion options.
+
+    Returns:
+        Encoded RGB image.
+    """
+    buffer = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as im:
+        if not needs_conversion(im, file_ext, options):
+            return data
+        encode_page(im, file_ext, options, buffer)
+    return buffer.getvalue()
+
+
+def convert_file(path: str, options: Dict) -> None:
+    """Convert a page on disk to RGB in place
+
+    Pages which are already reader-safe are left untouched.
+
+    Args:
+        path: path of the page.
+        options: conversion options.
+
+    Returns:
+        None.
+    """
+    # Convert file to RGB (readers don't like files with alpha channels or something).
+    with open(path, "rb") as f:
+        data = f.read()
+    with Image.open(io.BytesIO(data)) as im:
+        if needs_conversion(im, os.path.splitext(path)[-1], options):
+            encode_page(im, os.path.splitext(path)[-1], options, path)
+
+
+def map_pages(arguments: argparse.Namespace, function: Callable, *iterables: Iterable) -> Iterator:
+    """Run a page function over the page worker pool
+
+    Results are yielded in input order, and only a few pages per worker are
+    in flight at once so large books are never held in memory.
+
+    Args:
+        arguments: argument parser.
+        function: picklable function to call for every page.
+        iterables: iterables with the function arguments, like map().
+
+    Returns:
+        Iterator over the results.
+    """
+    workers = arguments.page_workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(function, *iterables)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        for item in zip(*iterables):
+            pending.append(executor.submit(function, *item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def can_stream(inputs: str) -> bool:
+    """Check if the pages of an input can be read without extracting it
+
+    Args:
+        inputs: input file or folder.
+
+    Returns:
+        True for CBZ files and folders, and for CBR files when rarfile is installed.
+    """
+    file_ext = os.path.splitext(inputs)[-1]
+    return file_ext == ".cbz" or (file_ext == ".cbr" and rarfile is not None) or os.path.isdir(inputs)
+
+
+def open_archive(inputs: str) -> zipfile.ZipFile:
+    """Open a CBZ or CBR file
+
+    Args:
+        inputs: input CBZ or CBR file.
+
+    Returns:
+        ZipFile, or a RarFile which has the same interface.
+    """
+    if os.path.splitext(inputs)[-1] == ".cbr":
+        return rarfile.RarFile(inputs)
+    return zipfile.ZipFile(inputs, "r")
+
+
+def list_pages(inputs: str) -> List[Tuple[Optional[str], str, str]]:
+    """List the pages of a CBZ or CBR file or folder without extracting anything
+
+    Args:
+        inputs: input CBZ or CBR file or folder.
+
+    Returns:
+        List of (last_dir, file, source) tuples, where source is the archive member name or file path.
+        Archive members are listed in archive order.
+    """
+    pages = []
+    if os.path.isdir(inputs):
+        for root, dirs, files in os.walk(inputs, topdown=False):
+            for file in sorted(files):
+                if os.path.normpath(root) == os.path.normpath(inputs):
+                    last_dir = None
+                else:
+                    last_dir = root.split(os.sep)[-1].replace(" ", "_")
+                pages.append((last_dir, file, os.path.join(root, file)))
+    else:
+        with open_archive(inputs) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                folder, file = os.path.split(info.filename.rstrip("/"))
+                last_dir = folder.split("/")[-1].replace(" ", "_") if folder else None
+                pages.append((last_dir, file, info.filename))
+    return pages
+
+
+def read_rar(inputs: str, members: List[str]) -> Iterator[bytes]:
+    """Read members of a CBR file in archive order
+
+    One long-lived "unrar p" process decompresses the whole archive to a pipe,
+    which is split into members by their listed sizes and checked against
+    their CRCs. Solid archives are then decompressed once, instead of once
+    per member. Without unrar, rarfile reads the members one at a time.
+
+    Args:
+        inputs: input CBR file.
+        members: names of the members to read, in archive order.
+
+    Returns:
+        Iterator over the member contents.
+    """
+    wanted = set(members)
+    with rarfile.RarFile(inputs) as rar_file:
+        infos = [info for info in rar_file.infolist() if not info.is_dir()]
+        process = None
+        if not any(info.needs_password() for info in infos):
+            try:
+                process = subprocess.Popen(
+                    [rarfile.UNRAR_TOOL, "p", "-inul", "--", inputs], stdout=subprocess.PIPE
+                )
+            except OSError:
+                process = None
+
+        if process is None:
+            for info in infos:
+                if info.filename in wanted:
+                    yield rar_file.read(info)
+            return
+
+        try:
+            for info in infos:
+                data = process.stdout.read(info.file_size)
+                if len(data) != info.file_size or (info.CRC is not None and zlib.crc32(data) != info.CRC):
+                    raise rarfile.BadRarFile(f"Failed to read {info.filename} from {inputs}")
+                if info.filename in wanted:
+                    yield data
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+
+def prefetch(iterator: Iterator, size: int) -> Iterator:
+    """Run an iterator in a background thread, keeping a few items ready
+
+    Reading and decompressing pages then overlaps with converting and zipping them.
+
+    Args:
+        iterator: iterator to run.
+        size: maximum number of items kept ready.
+
+    Returns:
+        Iterator over the same items.
+    """
+    items = queue.Queue(size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item: Tuple) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((None, e))
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def plan_pages(arguments: argparse.Namespace, pages: List[Tuple[Optional[str], str, str]]) -> List[Tuple[str, str]]:
+    """Plan the new name of every page
+
+    Pages are put in natural order, and names used more than once get a
+    numbered suffix instead of overwriting each other.
+
+    Args:
+        arguments: argument parser.
+        pages: pages as returned by list_pages().
+
+    Returns:
+        List of (source, new file name) tuples in natural order.
+    """
+    plan = []
+    targets = set()
+    suffixes = collections.Counter()
+    for last_dir, file, source in natsort.natsorted(pages, key=lambda page: page[2]):
+        new_file_name = page_name(arguments, last_dir, file)
+
+        # Duplicates typically happen when the same filename is used in multiple folders, but also if
+        # the digits is split with a space, dash or sommething, try to use --dontrename.
+        if new_file_name in targets:
+            name, file_ext = os.path.splitext(new_file_name)
+            while new_file_name in targets:
+                suffixes[name] += 1
+                new_file_name = "%s_%d%s" % (name, suffixes[name], file_ext)
+            print(f"WARNING: Duplicate filename {name + file_ext}, using {new_file_name} for {source}")
+
+        targets.add(new_file_name)
+        plan.append((source, new_file_name))
+    return plan
+
+
+def print_plan(plan: List[Tuple[str, str]]) -> None:
+    """Print a page plan
+
+    Args:
+        plan: plan as returned by plan_pages().
+
+    Returns:
+        None.
+    """
+    for source, new_file_name in plan:
+        print(f"    {source} -> {new_file_name}")
 
 
-def create_cbz(arguments: argparse.Namespace, inputs: str, file_list: List, index: int) -> None:
+def progress_bar(arguments: argparse.Namespace, inputs: str, total: int) -> tqdm:
+    """Create the page progress bar of an input
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        total: number of pages.
+
+    Returns:
+        Progress bar, disabled with --silence.
+    """
+    return tqdm(
+        total=total,
+        desc=os.path.basename(os.path.normpath(inputs)),
+        unit="page",
+        leave=False,
+        disable=arguments.silence,
+    )
+
+
+def stream_cbz(arguments: argparse.Namespace, inputs: str, metrics: Optional[Dict] = None) -> None:
+    """Convert a CBZ or CBR file or folder straight into the output CBZ
+
+    Every page is read from the source, renamed and converted in memory and
+    written directly into the new archive, so nothing touches a temp folder.
+
+    Args:
+        arguments: argument parser.
+        inputs: input CBZ or CBR file or folder.
+        metrics: metrics of the input to add stage timings to.
+
+    Returns:
+        None.
+    """
+    with timed(metrics, "plan"):
+        pages = list_pages(inputs)
+        plan = plan_pages(arguments, pages)
+    if metrics is not None:
+        metrics["pages"] = len(plan)
+    out_path = cbz_path(inputs)
+
+    # CBR files are read in archive order, solid archives can't be read in any other order.
+    if os.path.splitext(inputs)[-1] == ".cbr":
+        position = {source: number for number, (_, _, source) in enumerate(pages)}
+        plan.sort(key=lambda page: position[page[0]])
+
+    # Write to a partial file first, the source and output CBZ may share a name.
+    print("Creating a new CBZ file:")
+    print("    %s" % out_path)
+    partial_path = out_path + ".part"
+
+    def read_pages() -> Iterator[bytes]:
+        if os.path.isdir(inputs):
+            for source, _ in plan:
+                with open(source, "rb") as f:
+                    yield f.read()
+        elif os.path.splitext(inputs)[-1] == ".cbr":
+            yield from read_rar(inputs, [source for source, _ in plan])
+        else:
+            with zipfile.ZipFile(inputs, "r") as zip_file:
+                for source, _ in plan:
+                    yield zip_file.read(source)
+
+    try:
+        with zipfile.ZipFile(partial_path, "w") as zip_obj, progress_bar(arguments, inputs, len(plan)) as progress:
+            file_exts = [os.path.splitext(new_file_name)[-1] for _, new_file_name in plan]
+            converted = map_pages(
+                arguments,
+                convert_page,
+                prefetch(read_pages(), 4),
+                file_exts,
+                itertools.repeat(convert_options(arguments)),
+            )
+            for _, new_file_name in plan:
+                with timed(metrics, "convert"):
+                    data = next(converted)
+                with timed(metrics, "zip"):
+                    zip_obj.writestr(new_file_name, data)
+                progress.update(1)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, out_path)
+
+
+def create_cbz(arguments: argparse.Namespace, inputs: str, file_list: List) -> None:
     """Create CBZ file
 
     Args:
         arguments: argument parser.
         inputs: input file or folder.
         file_list: list of files to include in the CBZ file.
-        index: index of input.
 
     Returns:
         None.
@@ -133,165 +912,654 @@ def create_cbz(arguments: argparse.Namespace, inputs: str, file_list: List, inde
     print("Creating a new CBZ file:")
 
     # Output file name and print
-    out_file_name = os.path.splitext(inputs.split(os.sep)[-1])[0]
-    input_file_path = inputs.replace(inputs.split(os.sep)[-1], "")
-    print(input_file_path)
-    print("    %s.cbz" % os.path.join(input_file_path, out_file_name))
+    out_path = cbz_path(inputs)
+    print("    %s" % out_path)
 
     # Create a zip object
-    zip_obj = zipfile.ZipFile(
-        str(os.path.join(input_file_path, out_file_name) + ".cbz"), "w"
-    )
+    zip_obj = zipfile.ZipFile(out_path, "w")
 
     # Zip all files
     for file in file_list:
         zip_obj.write(file, basename(file))
     zip_obj.close()
 
-    # Delete the output folder
-    if os.path.exists(arguments.output + str(index)):
-        print(f"Clean up ({arguments.output + str(index)})")
-        try:
-            shutil.rmtree(arguments.output + str(index))
-        except Exception as e:
-            print(f"Failed to remove {arguments.output + str(index)} : {e}")
 
+def source_fingerprint(arguments: argparse.Namespace, inputs: str) -> str:
+    """Fingerprint an input file or folder
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+
+    Returns:
+        Hex digest over the content (--hash) or the size and modification time of all files.
+    """
+    if os.path.isdir(inputs):
+        paths = sorted(
+            os.path.join(root, file) for root, dirs, files in os.walk(inputs) for file in files
+        )
+    else:
+        paths = [inputs]
+
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.relpath(path, inputs).encode())
+        if arguments.hash:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        else:
+            stat = os.stat(path)
+            digest.update(b"%d:%d" % (stat.st_size, stat.st_mtime_ns))
+    return digest.hexdigest()
+
+
+def manifest_path(inputs: str) -> str:
+    """Determine the manifest path for an input
 
-def fix_files(arguments, inputs, index) -> None:
+    Args:
+        inputs: input file or folder.
+
+    Returns:
+        Path of the manifest in the output folder of the input.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(cbz_path(inputs))), manifest_name)
+
+
+def read_manifest(path: str) -> Dict:
+    """Read a manifest
+
+    Args:
+        path: manifest path.
+
+    Returns:
+        Manifest entries by input name, empty if there is no (valid) manifest.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def manifest_entry(arguments: argparse.Namespace, fingerprint: str, inputs: str) -> Dict:
+    """Build the manifest entry for a finished input
+
+    Args:
+        arguments: argument parser.
+        fingerprint: source fingerprint.
+        inputs: input file or folder.
+
+    Returns:
+        Manifest entry.
+    """
+    out_path = cbz_path(inputs)
+    return {
+        "source": fingerprint,
+        "hash": arguments.hash,
+        "options": {option: getattr(arguments, option) for option in manifest_options},
+        "output": os.path.basename(out_path),
+        "output_size": os.path.getsize(out_path),
+    }
+
+
+def is_up_to_date(arguments: argparse.Namespace, inputs: str, fingerprint: str) -> bool:
+    """Check the manifest to see if an input has to be converted
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        fingerprint: source fingerprint.
+
+    Returns:
+        True if the CBZ was built from the same source with the same options and is still there.
+    """
+    entry = read_manifest(manifest_path(inputs)).get(os.path.basename(os.path.normpath(inputs)))
+    out_path = cbz_path(inputs)
+    return (
+        entry is not None
+        and entry.get("source") == fingerprint
+        and entry.get("hash") == arguments.hash
+        and entry.get("options") == {option: getattr(arguments, option) for option in manifest_options}
+        and os.path.exists(out_path)
+        and os.path.getsize(out_path) == entry.get("output_size")
+    )
+
+
+def update_manifest(arguments: argparse.Namespace, inputs: str, fingerprint: str) -> None:
+    """Record a finished input in the manifest
+
+    The manifest is rewritten after every input so an interrupted run can be resumed.
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        fingerprint: source fingerprint.
+
+    Returns:
+        None.
+    """
+    path = manifest_path(inputs)
+    with manifest_lock:
+        manifest = read_manifest(path)
+        manifest[os.path.basename(os.path.normpath(inputs))] = manifest_entry(arguments, fingerprint, inputs)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+def fix_files(arguments, inputs, index, metrics=None) -> None:
     """Fix files
 
     Args:
         arguments: argument parser.
         inputs: input file or folder.
         index: index of input.
+        metrics: metrics of the input to add stage timings to.
 
     Returns:
         None.
     """
-    output_folder = default_output_folder + "_" + str(index)
+    # CBZ and CBR files and folders can be planned without extracting them.
+    if arguments.dry_run and can_stream(inputs):
+        print("Plan for %s:" % inputs)
+        print_plan(plan_pages(arguments, list_pages(inputs)))
+        return
+
+    # Stream CBZ and CBR files and folders straight into the output CBZ.
+    if arguments.stream and not arguments.onlyextract and can_stream(inputs):
+        print("Streaming %s..." % inputs)
+        stream_cbz(arguments, inputs, metrics)
+        return
+
+    # Every input gets its own temporary folder, so parallel jobs never share one.
+    work_dir = tempfile.mkdtemp(prefix="%s_%d_" % (default_output_folder, index), dir=arguments.temp_dir)
+    try:
+        convert_input(arguments, inputs, index, work_dir, metrics)
+    finally:
+        print("Clean up (%s)" % work_dir)
+        with timed(metrics, "cleanup"):
+            try:
+                shutil.rmtree(work_dir)
+            except Exception as e:
+                print(f"Failed to remove {work_dir} : {e}")
 
+
+def extract_input(arguments: argparse.Namespace, inputs: str, output_folder: str) -> bool:
+    """Extract an input to a folder
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        output_folder: folder to extract to.
+
+    Returns:
+        True if the pages are in output_folder and should be converted.
+    """
     if os.path.splitext(inputs)[-1] == ".cbr":
         print("Extracting CBR...")
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
         if arguments.onlyextract:
             extract_cbr(inputs, os.path.splitext(inputs)[0])
-            return
+            return False
         else:
+            os.makedirs(output_folder)
             extract_cbr(inputs, output_folder)
     elif os.path.splitext(inputs)[-1] == ".cbz":
         print("Extracting CBZ...")
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
         if arguments.onlyextract:
-            extract_pdf(inputs, os.path.splitext(inputs)[0])
-            return
+            extract_cbz(inputs, os.path.splitext(inputs)[0])
+            return False
         else:
             extract_cbz(inputs, output_folder)
     elif os.path.splitext(inputs)[-1] == ".pdf":
         print("Extracting PDF...")
+        workers = arguments.page_workers or os.cpu_count() or 1
         if arguments.onlyextract:
-            extract_pdf(inputs, os.path.splitext(inputs)[0])
-            return
+            extract_pdf(inputs, os.path.splitext(inputs)[0], arguments.dpi, workers)
+            return False
         else:
-            extract_pdf(inputs, output_folder)
+            extract_pdf(inputs, output_folder, arguments.dpi, workers)
     elif os.path.isdir(inputs):
         print("Processing folder")
         shutil.copytree(inputs, output_folder)
     else:
         print("Invalid input")
+        return False
+    return True
+
+
+def convert_input(
+    arguments: argparse.Namespace, inputs: str, index: int, work_dir: str, metrics: Optional[Dict] = None
+) -> None:
+    """Extract, rename, convert and zip one input using a temporary folder
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        index: index of input.
+        work_dir: temporary folder of this input.
+        metrics: metrics of the input to add stage timings to.
+
+    Returns:
+        None.
+    """
+    output_folder = os.path.join(work_dir, "extracted")
+    with timed(metrics, "extract"):
+        if not extract_input(arguments, inputs, output_folder):
+            return
+
+    # Plan all pages before anything is copied.
+    with timed(metrics, "plan"):
+        plan = plan_pages(arguments, list_pages(output_folder))
+    if metrics is not None:
+        metrics["pages"] = len(plan)
+
+    if arguments.dry_run:
+        print("Plan for %s:" % inputs)
+        print_plan(plan)
         return
 
     # Init a file list.
     file_list = []
 
-    # Fix all files in one folder with sub-folder names in each file.
-    if not os.path.exists(arguments.output + str(index)):
-        os.makedirs(arguments.output + str(index))
+    # Fix all files in one folder with sub-folder names in each file, only kept when extracting.
+    pages_folder = arguments.output + str(index) if arguments.onlyextract else os.path.join(work_dir, "pages")
+    if not os.path.exists(pages_folder):
+        os.makedirs(pages_folder)
 
     # Go through all images.
-    for root, dirs, files in os.walk(output_folder, topdown=False):
-        for file in sorted(files):
-            # Get directory name of last folder in tree unless default_output_folder.
-            if root.split(os.sep)[-1] == output_folder:
-                last_dir = None
-            else:
-                last_dir = root.split(os.sep)[-1].replace(" ", "_")
-
-            # Get file extension
-            file_ext = os.path.splitext(file)[-1]
-
-            # Rename images is chosen (cbz don't like 1.jpg and 10.jpg so zeroes should be added).
-            if arguments.dontrename:
-                file_name = os.path.splitext(file)[0]
-            else:
-                if last_dir is None:
-                    # If 'last_dir' is None, extract digits from 'file' and format
-                    # 'file_name' with leading zeros as a 4-digit number
-                    file_digits = re.search(r"\d+", file)
-                    file_name = "%04d" % (
-                        int(file_digits.group()) if file_digits else 0
-                    )
-                else:
-                    # If 'last_dir' is not None, extract digits from 'last_dir' and 'file'
-                    # then format 'file_name' as a 3-digit number concatenated with a 4-digit number
-                    last_dir_digits = re.search(r"\d+", last_dir)
-                    file_digits = re.search(r"\d+", file)
+    with timed(metrics, "convert"), progress_bar(arguments, inputs, len(plan)) as progress:
+        for source, new_file_name in plan:
+            # Determine destination and copy.
+            destination = os.path.join(pages_folder, new_file_name)
+            copyfile(source, destination)
 
-                    last_dir_number = (
-                        int(last_dir_digits.group()) if last_dir_digits else 0
-                    )
-                    file_number = int(file_digits.group()) if file_digits else 0
+            # Add the file to a list of files to return.
+            file_list.append(destination)
 
-                    file_name = "%03d%04d" % (last_dir_number, file_number)
+        # Convert all files to RGB on the page worker pool.
+        for _ in map_pages(arguments, convert_file, file_list, itertools.repeat(convert_options(arguments))):
+            progress.update(1)
 
-                    print(file_name)
+    if not arguments.onlyextract:
+        with timed(metrics, "zip"):
+            create_cbz(arguments, inputs, file_list)
 
-            # Determine new file name and print it out to see the progress.
-            new_file_name = file_name + file_ext
-            if not arguments.silence:
-                print(f"Creating {new_file_name}")
 
-            # Determine source path for upcoming copy.
-            source = os.path.join(root, file)
+def process_input(arguments: argparse.Namespace, inputs: str, index: int) -> Dict:
+    """Convert one input, skipping it if the manifest says it is up to date
 
-            # Determine destination for upcoming copy.
-            destination = os.path.join(arguments.output + str(index), new_file_name)
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        index: index of input.
 
-            # Copy file and check if file already exist,
-            # and exit if duplicate, because we will miss a file if we overwrite.
-            copyfile(source, destination)
-            if destination in file_list:
-                print("ERROR: Duplicate filename")
-                print("This error typically happens when the same filename is used in multiple folders, but also if "
-                      "the digits is split with a space, dash or sommething, try to use --dontrename")
-                sys.exit()
+    Returns:
+        Metrics of the input: stage timings, bytes in and out and pages/sec.
+    """
+    metrics = {"input": inputs, "index": index, "skipped": False, "pages": 0, "stages": {}}
+    metrics["bytes_in"] = input_size(inputs)
+    start = time.perf_counter()
 
-            # Add the file to a list of files to return.
-            file_list.append(destination)
+    if not arguments.incremental or arguments.onlyextract or arguments.dry_run:
+        fix_files(arguments, inputs, index, metrics)
+    else:
+        fingerprint = source_fingerprint(arguments, inputs)
+        if is_up_to_date(arguments, inputs, fingerprint):
+            print(f"Up to date ({inputs})")
+            metrics["skipped"] = True
+        else:
+            fix_files(arguments, inputs, index, metrics)
+
+            # A CBZ input is replaced by its output, so fingerprint the new file.
+            if os.path.exists(cbz_path(inputs)):
+                if os.path.abspath(cbz_path(inputs)) == os.path.abspath(inputs):
+                    fingerprint = source_fingerprint(arguments, inputs)
+                update_manifest(arguments, inputs, fingerprint)
+
+    metrics["wall_time"] = time.perf_counter() - start
+    out_path = cbz_path(inputs)
+    metrics["bytes_out"] = os.path.getsize(out_path) if os.path.exists(out_path) and not metrics["skipped"] else 0
+    metrics["pages_per_sec"] = metrics["pages"] / metrics["wall_time"] if metrics["wall_time"] else 0.0
+    return metrics
+
+
+def input_size(inputs: str) -> int:
+    """Size of an input file or folder
+
+    Args:
+        inputs: input file or folder.
+
+    Returns:
+        Size in bytes, 0 if the input doesn't exist.
+    """
+    if os.path.isdir(inputs):
+        return sum(
+            os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(inputs) for file in files
+        )
+    if os.path.isfile(inputs):
+        return os.path.getsize(inputs)
+    return 0
+
+
+def temp_bytes(arguments: argparse.Namespace, inputs: str, size: int) -> int:
+    """Estimate the temporary disk space an input needs
+
+    Args:
+        arguments: argument parser.
+        inputs: input file or folder.
+        size: input size in bytes.
+
+    Returns:
+        Estimated bytes, an extracted copy and a renamed copy of the pages.
+    """
+    if arguments.stream and not arguments.onlyextract and can_stream(inputs):
+        return 0
+    return 2 * size
+
+
+def run_jobs(
+    arguments: argparse.Namespace, inputs_list: List[str]
+) -> Tuple[List[Dict], List[Tuple[str, BaseException]]]:
+    """Process all inputs within the thread, in-flight and temporary space budgets
+
+    Inputs are started largest first. A job only starts when it fits the
+    budgets, except when nothing else is running, so one oversized input
+    can't stall the run. A failing input is reported and the rest go on.
+
+    Args:
+        arguments: argument parser.
+        inputs_list: input files or folders.
+
+    Returns:
+        Metrics of the finished inputs and (input, exception) tuples of the failed inputs.
+    """
+    sizes = [input_size(item) for item in inputs_list]
+    jobs = []
+    for index, item in sorted(enumerate(inputs_list), key=lambda pair: sizes[pair[0]], reverse=True):
+        jobs.append((index, item, temp_bytes(arguments, item, sizes[index])))
+
+    max_inflight = arguments.max_inflight or arguments.threads
+    condition = threading.Condition()
+    usage = {"inflight": 0, "temp_bytes": 0}
+    reports = []
+    failures = []
+
+    def fits(job: Tuple[int, str, int]) -> bool:
+        if usage["inflight"] == 0:
+            return True
+        if usage["inflight"] >= max_inflight:
+            return False
+        return arguments.max_temp_bytes is None or usage["temp_bytes"] + job[2] <= arguments.max_temp_bytes
+
+    def run(index: int, item: str, job_temp_bytes: int) -> None:
+        try:
+            reports.append(process_input(arguments, item, index))
+        except BaseException as e:
+            print(f"Failed to process {item} : {e!r}")
+            failures.append((item, e))
+        finally:
+            with condition:
+                usage["inflight"] -= 1
+                usage["temp_bytes"] -= job_temp_bytes
+                condition.notify_all()
+
+    with concurrent.futures.ThreadPoolExecutor(arguments.threads) as executor:
+        while jobs:
+            with condition:
+                job = next((job for job in jobs if fits(job)), None)
+                while job is None:
+                    condition.wait()
+                    job = next((job for job in jobs if fits(job)), None)
+                jobs.remove(job)
+                usage["inflight"] += 1
+                usage["temp_bytes"] += job[2]
+            executor.submit(run, *job)
+
+    reports.sort(key=lambda report: report["index"])
+    return reports, failures
+
+
+def write_metrics(path: str, reports: List[Dict], failures: List[Tuple[str, BaseException]], wall_time: float) -> None:
+    """Write the metrics report
+
+    Args:
+        path: JSON file to write.
+        reports: metrics of the finished inputs.
+        failures: (input, exception) tuples of the failed inputs.
+        wall_time: wall time of the whole run in seconds.
+
+    Returns:
+        None.
+    """
+    pages = sum(report["pages"] for report in reports)
+    stages = collections.Counter()
+    for report in reports:
+        stages.update(report["stages"])
+
+    summary = {
+        "wall_time": wall_time,
+        "inputs": len(reports) + len(failures),
+        "failed": len(failures),
+        "skipped": sum(report["skipped"] for report in reports),
+        "pages": pages,
+        "pages_per_sec": pages / wall_time if wall_time else 0.0,
+        "bytes_in": sum(report["bytes_in"] for report in reports),
+        "bytes_out": sum(report["bytes_out"] for report in reports),
+        "stages": dict(stages),
+        "peak_rss": peak_rss(),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "summary": summary,
+                "inputs": reports,
+                "failures": [{"input": item, "error": repr(error)} for item, error in failures],
+            },
+            f,
+            indent=2,
+        )
+
+
+def drop_fingerprint(path: str) -> Optional[Tuple[int, int, int]]:
+    """Cheap fingerprint of a dropped file or folder
+
+    Args:
+        path: dropped file or folder.
+
+    Returns:
+        (number of files, total size, latest modification time), None if it disappeared.
+    """
+    try:
+        if not os.path.isdir(path):
+            stat = os.stat(path)
+            return 1, stat.st_size, stat.st_mtime_ns
+        count, size, mtime = 0, 0, os.stat(path).st_mtime_ns
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                stat = os.stat(os.path.join(root, file))
+                count, size, mtime = count + 1, size + stat.st_size, max(mtime, stat.st_mtime_ns)
+        return count, size, mtime
+    except OSError:
+        return None
+
+
+def scan_drops(arguments: argparse.Namespace) -> Dict[str, Tuple[int, int, int]]:
+    """Fingerprint everything in the watch folder that can be converted
+
+    Args:
+        arguments: argument parser.
+
+    Returns:
+        Fingerprints by path.
+    """
+    drops = {}
+    for entry in os.scandir(arguments.watch):
+        # Skip hidden files like the manifest, partial CBZ files and our own temporary folder.
+        if entry.name.startswith(".") or entry.name.endswith(".part"):
+            continue
+        if arguments.temp_dir and os.path.abspath(entry.path) == os.path.abspath(arguments.temp_dir):
+            continue
+        if not entry.is_dir() and os.path.splitext(entry.name)[-1].lower() not in (".cbr", ".cbz", ".pdf"):
+            continue
+        fingerprint = drop_fingerprint(entry.path)
+        if fingerprint is not None:
+            drops[entry.path] = fingerprint
+    return drops
+
+
+def watch_state_path(arguments: argparse.Namespace) -> str:
+    """Determine the path of the --watch state file
+
+    Args:
+        arguments: argument parser.
+
+    Returns:
+        Path of the state file in the watch folder, next to the CBZ files it describes.
+    """
+    return os.path.join(arguments.watch, watch_state_name)
+
+
+def read_watch_state(arguments: argparse.Namespace) -> Dict[str, Tuple[int, int, int]]:
+    """Read the fingerprints of drops converted before a restart
+
+    Args:
+        arguments: argument parser.
+
+    Returns:
+        Fingerprints by path, empty if there is no (valid) state file.
+    """
+    state = read_manifest(watch_state_path(arguments))
+    return {os.path.join(arguments.watch, name): tuple(fingerprint) for name, fingerprint in state.items()}
+
+
+def write_watch_state(arguments: argparse.Namespace, done: Dict[str, Tuple[int, int, int]]) -> None:
+    """Store the fingerprints of converted drops, so a restart doesn't convert them again
+
+    Args:
+        arguments: argument parser.
+        done: fingerprints of converted drops and their CBZ files.
 
-            # Convert file to RGB (readers don't like files with alpha channels or something).
-            im = Image.open(destination).convert("RGB")
-            im.save(destination)
-            im.close()
+    Returns:
+        None.
+    """
+    path = watch_state_path(arguments)
+    with manifest_lock:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({os.path.basename(item): fingerprint for item, fingerprint in done.items()}, f, indent=2,
+                      sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+async def watch_worker(
+    arguments: argparse.Namespace,
+    jobs: asyncio.Queue,
+    executor: concurrent.futures.Executor,
+    done: Dict[str, Tuple[int, int, int]],
+    indexes: Iterator[int],
+) -> None:
+    """Convert queued drops one at a time on the executor
+
+    Args:
+        arguments: argument parser.
+        jobs: queue of (path, time queued) tuples.
+        executor: executor running the conversions.
+        done: fingerprints of converted drops and their CBZ files, updated here.
+        indexes: source of job indexes.
 
-    # Remove folders
-    if os.path.exists(output_folder):
-        print("Clean up (%s)" % output_folder)
+    Returns:
+        None.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        path, queued = await jobs.get()
+        started = time.monotonic()
         try:
-            shutil.rmtree(output_folder)
+            await loop.run_in_executor(executor, process_input, arguments, path, next(indexes))
+            status = "Converted"
         except Exception as e:
-            print(f"Failed to remove {output_folder} : {e}")
+            status = f"Failed ({e!r})"
+        finally:
+            # Remember the drop and the CBZ we wrote, so they aren't picked up again.
+            for converted in (path, cbz_path(path)):
+                fingerprint = await loop.run_in_executor(None, drop_fingerprint, converted)
+                if fingerprint is not None:
+                    done[converted] = fingerprint
+            await loop.run_in_executor(None, write_watch_state, arguments, dict(done))
+            jobs.task_done()
+
+        finished = time.monotonic()
+        print(
+            f"{status} {path}: waited {started - queued:.1f} s, converted in {finished - started:.1f} s, "
+            f"latency {finished - queued:.1f} s, queue depth {jobs.qsize()}"
+        )
+
+
+async def watch(arguments: argparse.Namespace) -> None:
+    """Watch a folder and convert everything dropped in it
 
-    if not args.onlyextract:
-        create_cbz(args, inputs, file_list, index)
+    A drop is queued once its fingerprint has stayed the same for --settle
+    seconds, so files and folders still being copied are left alone.
+
+    Fingerprints of converted drops and their CBZ files are kept in a state
+    file, so they aren't converted again after a restart. A CBZ that is the
+    output of another drop is never queued, it may be being written.
+
+    Args:
+        arguments: argument parser.
+
+    Returns:
+        None.
+    """
+    loop = asyncio.get_running_loop()
+    jobs = asyncio.Queue()
+    done = read_watch_state(arguments)
+    settling = {}
+    indexes = itertools.count()
+
+    print(f"Watching {arguments.watch}, press Ctrl+C to stop")
+    with concurrent.futures.ThreadPoolExecutor(arguments.threads) as executor:
+        workers = [
+            asyncio.create_task(watch_worker(arguments, jobs, executor, done, indexes))
+            for _ in range(arguments.threads)
+        ]
+        try:
+            while True:
+                drops = await loop.run_in_executor(None, scan_drops, arguments)
+                now = time.monotonic()
+                outputs = {cbz_path(path) for path in itertools.chain(drops, done) if cbz_path(path) != path}
+                for path, fingerprint in drops.items():
+                    if done.get(path) == fingerprint or path in outputs:
+                        continue
+                    if path not in settling or settling[path][0] != fingerprint:
+                        settling[path] = (fingerprint, now)
+                    elif now - settling[path][1] >= arguments.settle:
+                        del settling[path]
+                        done[path] = fingerprint
+                        jobs.put_nowait((path, now))
+                        print(f"Queued {path}, queue depth {jobs.qsize()}")
+
+                # Forget drops which were removed.
+                for path in set(settling) - set(drops):
+                    del settling[path]
+
+                await asyncio.sleep(arguments.poll)
+        finally:
+            for worker in workers:
+                worker.cancel()
 
 
 if __name__ == "__main__":
 
     args = parser()
 
-    threads = []
+    # Keep converting drops until stopped.
+    if args.watch:
+        try:
+            asyncio.run(watch(args))
+        except KeyboardInterrupt:
+            print("Stopped")
+        sys.exit()
 
     # Handle multiple inputs.
     if "," in args.input[0]:
@@ -308,22 +1576,16 @@ if __name__ == "__main__":
 
         args.input = sub_folders
 
-    max_threads = args.threads  # Maximum number of threads to run concurrently
-
-    with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
-        futures = []
-
-        for item in args.input:
-            future = executor.submit(fix_files, args, item, args.input.index(item))
-            futures.append(future)
+    start_time = time.perf_counter()
+    metrics_reports, failed = run_jobs(args, args.input)
 
-        # Wait for all threads to complete
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
+    if args.metrics:
+        write_metrics(args.metrics, metrics_reports, failed, time.perf_counter() - start_time)
 
-        # Optionally, you can check for exceptions in the results
-        for future in futures:
-            if future.exception() is not None:
-                print(f"Thread raised an exception: {future.exception()}")
+    # Report the inputs that failed without stopping the others.
+    if failed:
+        print(f"{len(failed)} of {len(args.input)} inputs failed:")
+        for item, error in failed:
+            print(f"    {item} : {error!r}")
 
     print("Done")
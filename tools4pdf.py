@@ -1,10 +1,42 @@
 import os
+import io
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import math
+import subprocess
+import tempfile
+import zipfile
+import zlib
 import img2pdf
+import natsort
+import ocrmypdf
+import pikepdf
 import PyPDF2
 from pprint import pprint
+from PIL import Image
 
-image_types = (".jpg", ".jpeg")
+try:
+    import rarfile
+except ImportError:  # CBR files can't be read then.
+    rarfile = None
+
+image_types = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp")
+
+# Images img2pdf embeds without re-encoding through Pillow, unless they have transparency.
+passthrough_formats = ("JPEG", "PNG", "TIFF")
+alpha_modes = ("RGBA", "LA", "PA", "RGBa", "La")
+
+# Images per in-memory img2pdf PDF, bounds the image data held at once.
+image_run_size = 50
+
+# PDFs open at once while merging, more inputs are merged in chunks of this many.
+merge_chunk_size = 100
+
+# Bytes of out of order CBR pages held in memory before they are spooled to disk.
+spool_size = 64 * 1024 * 1024
 
 
 def arg_parser():
@@ -29,11 +61,233 @@ def arg_parser():
                         help="Do OCR on input document")
     parser.add_argument("-l", "--language", type=str, default="eng",
                         help="OCR language from Tesserect")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Number of OCR processes (default all cores)")
+    parser.add_argument("--shard_size", type=int, default=50,
+                        help="Number of pages given to OCR at a time")
+    parser.add_argument("--ocr_cache", type=str, default=None,
+                        help="Folder for OCR'ed pages (default .ocr_cache next to the document)")
+    parser.add_argument("--batch", action='store_true',
+                        help="Make one PDF per sub folder of the input folder, output is then the output folder")
+    parser.add_argument("--batch_list", type=str, default=None,
+                        help="Make one PDF per line of this file, 'folder' or 'folder<TAB>output name'")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes for batch mode and --optimize (default all cores)")
+    parser.add_argument("--optimize", action='store_true',
+                        help="Downsample and recompress images shown at more than --target_dpi")
+    parser.add_argument("--target_dpi", type=int, default=150,
+                        help="Resolution images are downsampled to with --optimize")
+    parser.add_argument("--jpeg_quality", type=int, default=75,
+                        help="JPEG quality of images recompressed by --optimize")
+    parser.add_argument("--stream_merge", action='store_true',
+                        help="Merge with bounded memory and store identical images and fonts once")
     print('\n' + str(parser.parse_args()) + '\n')
 
     return parser.parse_args()
 
 
+def probe_image(image):
+
+    """Prepare an image for img2pdf
+
+    Only the header is read for images img2pdf can embed as is (JPEG is
+    embedded byte-for-byte). Images with transparency or in other formats,
+    like WebP, are flattened on white and re-encoded losslessly as PNG.
+
+    Args:
+        image: image file or image bytes
+
+    Returns:
+        The image if it can be embedded as is, otherwise PNG bytes
+    """
+
+    with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as im:
+        if im.format in passthrough_formats and im.mode not in alpha_modes and "transparency" not in im.info:
+            return image
+
+        im = im.convert("RGBA")
+        page = Image.new("RGB", im.size, (255, 255, 255))
+        page.paste(im, mask=im)
+
+    buffer = io.BytesIO()
+    page.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def open_archive(filename):
+
+    """Open a CBZ or CBR file
+
+    Args:
+        filename: CBZ or CBR file
+
+    Returns:
+        zipfile.ZipFile or rarfile.RarFile
+    """
+
+    if filename.lower().endswith(".cbr"):
+        if rarfile is None:
+            raise ImportError("rarfile is needed to read CBR files, install it with 'pip install rarfile'")
+        return rarfile.RarFile(filename)
+    return zipfile.ZipFile(filename, "r")
+
+
+def archive_members(filename):
+
+    """List the images of a CBZ or CBR file in natural order
+
+    Args:
+        filename: CBZ or CBR file
+
+    Returns:
+        List of member names
+    """
+
+    with open_archive(filename) as archive:
+        return natsort.natsorted(
+            info.filename for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith(image_types)
+        )
+
+
+def read_rar(filename):
+
+    """Read the members of a CBR file in archive order
+
+    One "unrar p" process decompresses the whole archive to a pipe, which
+    is split into members by their listed sizes and checked against their
+    CRCs, so solid archives are decompressed once instead of once per
+    member. Without unrar, rarfile reads the members one at a time.
+
+    Args:
+        filename: CBR file
+
+    Returns:
+        Generator of (member name, bytes)
+    """
+
+    with rarfile.RarFile(filename) as archive:
+        infos = [info for info in archive.infolist() if not info.is_dir()]
+        process = None
+        if not any(info.needs_password() for info in infos):
+            try:
+                process = subprocess.Popen([rarfile.UNRAR_TOOL, "p", "-inul", "--", filename],
+                                           stdout=subprocess.PIPE)
+            except OSError:
+                process = None
+
+        if process is None:
+            for info in infos:
+                yield info.filename, archive.read(info)
+            return
+
+        try:
+            for info in infos:
+                data = process.stdout.read(info.file_size)
+                if len(data) != info.file_size or (info.CRC is not None and zlib.crc32(data) != info.CRC):
+                    raise rarfile.BadRarFile("Failed to read %s from %s" % (info.filename, filename))
+                yield info.filename, data
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+
+def read_archive(filename, members):
+
+    """Read images of a CBZ or CBR file one at a time
+
+    CBR files are decompressed in archive order with read_rar(), pages
+    coming before their turn are spooled until they are needed.
+
+    Args:
+        filename: CBZ or CBR file
+        members: member names, in the order to read them
+
+    Returns:
+        Generator of image bytes
+    """
+
+    if not filename.lower().endswith(".cbr"):
+        with open_archive(filename) as archive:
+            for member in members:
+                yield archive.read(member)
+        return
+
+    if rarfile is None:
+        raise ImportError("rarfile is needed to read CBR files, install it with 'pip install rarfile'")
+
+    wanted = set(members)
+    spooled = {}
+    position = 0
+    with tempfile.SpooledTemporaryFile(spool_size) as spool:
+        for name, data in read_rar(filename):
+            if position == len(members):
+                break
+            if name != members[position]:
+                if name in wanted:
+                    spool.seek(0, os.SEEK_END)
+                    spooled[name] = (spool.tell(), len(data))
+                    spool.write(data)
+                continue
+
+            yield data
+            position += 1
+            while position < len(members) and members[position] in spooled:
+                offset, size = spooled.pop(members[position])
+                spool.seek(offset)
+                yield spool.read(size)
+                position += 1
+
+
+def images_pdf(images, executor):
+
+    """Convert a run of images into one in-memory PDF
+
+    Args:
+        images: image files and image bytes
+        executor: executor probing the images in parallel
+
+    Returns:
+        BytesIO with the PDF
+    """
+
+    return io.BytesIO(img2pdf.convert(list(executor.map(probe_image, images))))
+
+
+def build_sources(file_list):
+
+    """Turn sorted images and PDFs into PDF sources for merging
+
+    Consecutive images are converted into in-memory PDFs with img2pdf, so
+    no temporary file is written. Sources are made one at a time while the
+    merge takes them, and runs of images are cut every image_run_size
+    images, so only one run of image data is held in memory at once.
+
+    Args:
+        file_list: sorted image and PDF files, and image bytes, may be a generator
+
+    Returns:
+        Generator of PDF paths and in-memory PDFs, in the order of file_list
+    """
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        pending_images = []
+        for item in file_list:
+            if isinstance(item, bytes) or item.lower().endswith(image_types):
+                pending_images.append(item)
+                if len(pending_images) == image_run_size:
+                    yield images_pdf(pending_images, executor)
+                    pending_images = []
+                continue
+            if pending_images:
+                yield images_pdf(pending_images, executor)
+                pending_images = []
+            yield item
+        if pending_images:
+            yield images_pdf(pending_images, executor)
+
+
 def create_pdf(arguments):
     """Create images or pdf files to pdf
 
@@ -41,71 +295,625 @@ def create_pdf(arguments):
         arguments: argument parser
 
     Returns:
-        None
+        True if the PDF was created, False if there was nothing to put in it
     """
 
     # Contains the list of all images and PDFs to be converted to a single PDF.
-    image_list = []
-    pdf_list = []
+    file_list = []
 
     folder = arguments.inputs
 
-    # Find files
-    for dir_path, _, filenames in os.walk(folder):
-        for filename in filenames:
-            full_path = os.path.join(dir_path, filename)
-            if filename.endswith(image_types):
-                image_list.append(full_path)
-            elif filename.endswith(".pdf"):
-                pdf_list.append(full_path)
+    # Comics are read straight from the archive, a PDF is used as is.
+    if folder.lower().endswith((".cbz", ".cbr")):
+        members = archive_members(folder)
+        pprint(members)
+        file_list = read_archive(folder, members) if members else []
+    elif folder.lower().endswith(".pdf"):
+        file_list = [folder]
+        pprint(file_list)
+    else:
+        # Find files
+        for dir_path, _, filenames in os.walk(folder):
+            for filename in filenames:
+                full_path = os.path.join(dir_path, filename)
+                if filename.lower().endswith(image_types + (".pdf",)):
+                    file_list.append(full_path)
 
-    # Sort files
-    image_list.sort()
-    pdf_list.sort()
+        # Sort files, images and PDFs end up in the output in this order
+        file_list.sort()
 
-    pprint(pdf_list)
+        pprint(file_list)
 
     # Handle the case where there are no images or PDFs
-    if not image_list and not pdf_list:
-        print("Error: No images or PDFs found in the specified folder.")
-        return  # Exit the function if no valid files are found
-
-    # Create a temporary PDF from images if there are images
-    if image_list:
-        with open("temp_images.pdf", "wb") as f:
-            f.write(img2pdf.convert(image_list))
-    else:
-        # If no images are found, create an empty temporary PDF to keep the workflow intact
-        with open("temp_images.pdf", "wb") as f:
-            f.write(b"")  # Empty PDF file that won't cause an error
-
-    # Merge all PDFs
-    merger = PyPDF2.PdfMerger()
+    if not file_list:
+        print("Error: No images or PDFs found in the specified input.")
+        return False  # Exit the function if no valid files are found
 
-    # Add the converted images PDF only if there were images
-    if image_list:
-        merger.append("temp_images.pdf")
+    pdf_list = build_sources(file_list)
 
-    # Add the other PDFs if available
-    for pdf in pdf_list:
-        merger.append(pdf)
+    # Merge all PDFs
+    if arguments.stream_merge:
+        merge_pdfs_streaming(pdf_list, arguments.output + ".pdf")
+    else:
+        merger = PyPDF2.PdfMerger()
+        for pdf in pdf_list:
+            merger.append(pdf)
 
-    # Write out the merged PDF
-    with open(arguments.output + ".pdf", "wb") as f:
-        merger.write(f)
+        # Write out the merged PDF
+        with open(arguments.output + ".pdf", "wb") as f:
+            merger.write(f)
 
-    # Clean up temporary file
-    os.remove("temp_images.pdf")
+    # Shrink oversized images before OCR, so OCR works on the final images
+    if arguments.optimize:
+        optimize_pdf(arguments.output + ".pdf", arguments)
 
     # If OCR is required, run OCR on the output PDF
     if arguments.ocr:
         create_ocr(arguments.output + ".pdf", arguments)
 
+    return True
+
+
+def batch_jobs(arguments):
+
+    """List the jobs of a batch run
+
+    Args:
+        arguments: argument parser
+
+    Returns:
+        List of (input folder, output filename) tuples
+    """
+
+    jobs = []
+    if arguments.batch_list:
+        with open(arguments.batch_list, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                folder, _, output = line.rstrip("\r\n").partition("\t")
+                folder = folder.strip()
+                output = output.strip() or os.path.basename(os.path.normpath(folder))
+                # Only a .pdf suffix is dropped, dots are common in names like "Series v1.5".
+                if output.lower().endswith(".pdf"):
+                    output = output[:-4]
+                jobs.append((folder, os.path.join(arguments.output, output)))
+    else:
+        for entry in sorted(os.scandir(arguments.inputs), key=lambda entry: entry.name):
+            if entry.is_dir():
+                jobs.append((entry.path, os.path.join(arguments.output, entry.name)))
+    return jobs
+
+
+def batch_job(arguments, folder, output):
+
+    """Create one PDF of a batch run
+
+    Args:
+        arguments: argument parser
+        folder: input folder
+        output: output filename
+
+    Returns:
+        None
+    """
+
+    job_arguments = argparse.Namespace(**vars(arguments))
+    job_arguments.inputs = folder
+    job_arguments.output = output
+    if not create_pdf(job_arguments):
+        raise ValueError("No images or PDFs found")
+
+
+def create_batch(arguments):
+
+    """Create many PDFs at once on a process pool
+
+    Args:
+        arguments: argument parser
+
+    Returns:
+        None
+    """
+
+    jobs = batch_jobs(arguments)
+    os.makedirs(arguments.output, exist_ok=True)
+    print(f"Creating {len(jobs)} PDFs in {arguments.output}")
+
+    # Jobs writing the same PDF would overwrite each other on the pool, none of them is run.
+    failures = []
+    outputs = collections.Counter(os.path.normcase(os.path.abspath(output)) for _, output in jobs)
+    for folder, output in jobs:
+        if outputs[os.path.normcase(os.path.abspath(output))] > 1:
+            failures.append((folder, ValueError(f"{output}.pdf is the output of more than one job")))
+            print(f"Failed: {folder} ({failures[-1][1]!r})")
+    runnable = [job for job in jobs if outputs[os.path.normcase(os.path.abspath(job[1]))] == 1]
+
+    with concurrent.futures.ProcessPoolExecutor(arguments.workers) as executor:
+        futures = {executor.submit(batch_job, arguments, folder, output): folder for folder, output in runnable}
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                failures.append((futures[future], future.exception()))
+                print(f"Failed: {futures[future]} ({future.exception()!r})")
+
+    # Summary
+    print(f"Created {len(jobs) - len(failures)} of {len(jobs)} PDFs")
+    for folder, error in sorted(failures, key=lambda failure: failure[0]):
+        print(f"    {folder}: {error!r}")
+
+
+def stream_key(stream):
+
+    """Key identifying a stream by its content
+
+    Indirect objects in the stream dictionary count by reference, so only
+    streams which are truly the same get the same key.
+
+    Args:
+        stream: pikepdf stream
+
+    Returns:
+        Hex digest of the stream dictionary and raw data
+    """
+
+    digest = hashlib.sha256()
+    for key in sorted(stream.keys()):
+        if key != "/Length":
+            value = stream.get(key)
+            value = value.unparse() if isinstance(value, pikepdf.Object) else repr(value).encode()
+            digest.update(key.encode() + value)
+    digest.update(stream.read_raw_bytes())
+    return digest.hexdigest()
+
+
+def share_stream(stream, shared, seen):
+
+    """Get the shared copy of a stream, making it the shared copy if it is new
+
+    Args:
+        stream: pikepdf stream
+        shared: shared streams by stream_key()
+        seen: shared streams by object id, so every object is only hashed once
+
+    Returns:
+        Stream to use instead
+    """
+
+    if stream.objgen in seen:
+        return seen[stream.objgen]
+
+    # Masks are shared first, so images with identical masks get the same key.
+    if "/SMask" in stream:
+        stream.SMask = share_stream(stream.SMask, shared, seen)
+
+    key = stream_key(stream)
+    seen[stream.objgen] = shared.setdefault(key, stream)
+    return seen[stream.objgen]
+
+
+def share_resources(page, shared, seen):
+
+    """Point the images and embedded fonts of a page to shared copies
+
+    Args:
+        page: pikepdf page
+        shared: shared streams by stream_key()
+        seen: shared streams by object id
+
+    Returns:
+        None
+    """
+
+    resources = page.obj.get("/Resources")
+    if resources is None:
+        return
+
+    x_objects = resources.get("/XObject", {})
+    for name in list(x_objects.keys()):
+        x_object = x_objects[name]
+        if isinstance(x_object, pikepdf.Stream) and x_object.get("/Subtype") == "/Image":
+            x_objects[name] = share_stream(x_object, shared, seen)
+
+    for font in resources.get("/Font", {}).values():
+        descriptor = font.get("/FontDescriptor")
+        if descriptor is None:
+            continue
+        for font_file in ("/FontFile", "/FontFile2", "/FontFile3"):
+            if font_file in descriptor:
+                descriptor[font_file] = share_stream(descriptor[font_file], shared, seen)
+
+
+def merge_pdf_files(paths, output):
+
+    """Merge PDF files, storing byte-identical images and embedded fonts once
+
+    Args:
+        paths: PDF paths to merge, in order
+        output: output filename
+
+    Returns:
+        None
+    """
+
+    merged = pikepdf.Pdf.new()
+    sources = []
+    shared = {}
+    seen = {}
+    try:
+        for path in paths:
+            source = pikepdf.open(path)
+            sources.append(source)
+            for page in source.pages:
+                merged.pages.append(page)
+                share_resources(merged.pages[-1], shared, seen)
+
+        merged.save(output)
+    finally:
+        merged.close()
+        for source in sources:
+            source.close()
+
+
+def merge_pdfs_streaming(pdf_list, output):
+
+    """Merge PDFs with bounded memory
+
+    Pages are copied one input at a time with pikepdf (qpdf), which only
+    copies the object structure and reads the page content, image and font
+    data from the inputs while the output is written, so memory doesn't
+    grow with the size of the inputs. In-memory inputs are spilled to
+    temporary files for this, as they would otherwise all be held until
+    the output is written. Every input stays open until its output is
+    written, so more than merge_chunk_size inputs are first merged in
+    chunks into temporary files. Byte-identical images and embedded fonts
+    are stored once.
+
+    Args:
+        pdf_list: PDF paths or file objects to merge, in order, may be a generator
+        output: output filename
+
+    Returns:
+        None
+    """
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        counter = itertools.count()
+
+        def merge_chunk(paths):
+            chunk = os.path.join(temp_dir, "chunk_%d.pdf" % next(counter))
+            merge_pdf_files(paths, chunk)
+            # Spilled inputs and earlier chunks aren't needed anymore.
+            for path in paths:
+                if os.path.dirname(path) == temp_dir:
+                    os.remove(path)
+            return chunk
+
+        chunks = []
+        pending = []
+        for pdf in pdf_list:
+            if isinstance(pdf, io.BytesIO):
+                path = os.path.join(temp_dir, "%d.pdf" % next(counter))
+                with open(path, "wb") as f:
+                    f.write(pdf.getbuffer())
+                pdf = path
+            if len(pending) == merge_chunk_size:
+                chunks.append(merge_chunk(pending))
+                pending = []
+            pending.append(pdf)
+
+        paths = chunks + pending
+        while len(paths) > merge_chunk_size:
+            paths = [merge_chunk(paths[i:i + merge_chunk_size]) for i in range(0, len(paths), merge_chunk_size)]
+        merge_pdf_files(paths, output)
+
+
+def image_scales(pdf, target_dpi):
+
+    """Find the images shown at more than the target resolution
+
+    The content stream of every page is followed to get the size each
+    image is drawn at. An image drawn more than once is scaled for the
+    largest of them, so it never ends up under the target anywhere.
+
+    Args:
+        pdf: pikepdf document
+        target_dpi: target resolution
+
+    Returns:
+        Dictionary of object id to (scale, number of first page showing it) for images to downsample
+    """
+
+    scales = {}
+    for page_number, page in enumerate(pdf.pages):
+        x_objects = page.obj.get("/Resources", {}).get("/XObject", {})
+        ctm = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+        stack = []
+        for operands, operator in pikepdf.parse_content_stream(page, "q Q cm Do"):
+            if operator == pikepdf.Operator("q"):
+                stack.append(ctm)
+            elif operator == pikepdf.Operator("Q") and stack:
+                ctm = stack.pop()
+            elif operator == pikepdf.Operator("cm"):
+                a, b, c, d, e, f = (float(operand) for operand in operands)
+                ctm = (a * ctm[0] + b * ctm[2], a * ctm[1] + b * ctm[3],
+                       c * ctm[0] + d * ctm[2], c * ctm[1] + d * ctm[3],
+                       e * ctm[0] + f * ctm[2] + ctm[4], e * ctm[1] + f * ctm[3] + ctm[5])
+            elif operator == pikepdf.Operator("Do"):
+                image = x_objects.get(operands[0])
+                if not isinstance(image, pikepdf.Stream) or image.get("/Subtype") != "/Image":
+                    continue
+
+                # Stencil and color key masked images are left alone.
+                if image.get("/ImageMask", False) or "/Mask" in image:
+                    continue
+
+                # Shown size in inches, the unit square is mapped by the CTM.
+                shown_width = math.hypot(ctm[0], ctm[1]) / 72
+                shown_height = math.hypot(ctm[2], ctm[3]) / 72
+                if not shown_width or not shown_height:
+                    continue
+
+                dpi = min(int(image.Width) / shown_width, int(image.Height) / shown_height)
+                scale = min(1.0, target_dpi / dpi)
+                if image.objgen in scales:
+                    scale = max(scale, scales[image.objgen][0])
+                    page_number = scales[image.objgen][1]
+                scales[image.objgen] = (scale, page_number)
+
+    return {objgen: value for objgen, value in scales.items() if value[0] < 1.0}
+
+
+# PDF opened by each --optimize worker process.
+optimize_source = None
+
+
+def optimize_worker_init(filename):
+
+    """Open the PDF being optimized in a worker process
+
+    Args:
+        filename: PDF file
+
+    Returns:
+        None
+    """
+
+    global optimize_source
+    optimize_source = pikepdf.open(filename)
+
+
+def downsample_image(objgen, scale, quality):
+
+    """Downsample and recompress one image of the PDF opened by this worker
+
+    Args:
+        objgen: object id of the image
+        scale: factor to scale both sides with
+        quality: JPEG quality
+
+    Returns:
+        (object id, JPEG bytes, (width, height), mode), or None if the image can't be read or doesn't get smaller
+    """
+
+    image = optimize_source.get_object(objgen)
+    try:
+        im = pikepdf.PdfImage(image).as_pil_image()
+    except Exception:
+        return None
+
+    if im.mode not in ("RGB", "L"):
+        im = im.convert("RGB")
+    size = (max(1, round(im.width * scale)), max(1, round(im.height * scale)))
+    im = im.resize(size, Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    im.save(buffer, format="JPEG", quality=quality, optimize=True)
+    if buffer.tell() >= len(image.read_raw_bytes()):
+        return None
+    return objgen, buffer.getvalue(), size, im.mode
+
+
+def optimize_pdf(filename, arguments):
+
+    """Downsample the images of a PDF shown at more than the target resolution
+
+    Images are downsampled and recompressed as JPEG on a process pool, and
+    the PDF is rewritten in place. Images already under the target, or
+    that wouldn't get smaller, are kept.
+
+    Args:
+        filename: PDF file
+        arguments: argument parser
+
+    Returns:
+        None
+    """
+
+    with pikepdf.open(filename, allow_overwriting_input=True) as pdf:
+        scales = image_scales(pdf, arguments.target_dpi)
+        print(f"Downsampling {len(scales)} images to {arguments.target_dpi} dpi")
+
+        saved = {}
+        with concurrent.futures.ProcessPoolExecutor(
+            arguments.workers, initializer=optimize_worker_init, initargs=(filename,)
+        ) as executor:
+            futures = [
+                executor.submit(downsample_image, objgen, scale, arguments.jpeg_quality)
+                for objgen, (scale, _) in scales.items()
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                if result is None:
+                    continue
+
+                # Replace the image stream with the recompressed JPEG.
+                objgen, data, size, mode = result
+                image = pdf.get_object(objgen)
+                old_size = len(image.read_raw_bytes())
+                image.write(data, filter=pikepdf.Name.DCTDecode)
+                image.Width, image.Height = size
+                image.ColorSpace = pikepdf.Name.DeviceRGB if mode == "RGB" else pikepdf.Name.DeviceGray
+                image.BitsPerComponent = 8
+                for key in ("/DecodeParms", "/Decode"):
+                    if key in image:
+                        del image[key]
+
+                page_number = scales[objgen][1]
+                saved[page_number] = saved.get(page_number, 0) + old_size - len(data)
+
+        pdf.save(filename)
+
+    # Report
+    for page_number in sorted(saved):
+        print(f"Page {page_number + 1}: saved {saved[page_number]} bytes")
+    print(f"Saved {sum(saved.values())} bytes in total")
+
+
+def hash_object(obj, digest, visited):
+
+    """Feed a PDF object into a digest by content
+
+    Indirect objects are followed, except for the /Parent of pages, and
+    objects seen before are fed as a back reference so cycles end.
+
+    Args:
+        obj: pikepdf object or Python scalar
+        digest: hashlib digest to update
+        visited: visit number by object id of the indirect objects seen
+
+    Returns:
+        None
+    """
+
+    if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        if obj.objgen in visited:
+            digest.update(b"R%d" % visited[obj.objgen])
+            return
+        visited[obj.objgen] = len(visited)
+
+    if isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream)):
+        digest.update(b"<<")
+        for key in sorted(obj.keys()):
+            if key not in ("/Parent", "/Length"):
+                digest.update(key.encode())
+                hash_object(obj.get(key), digest, visited)
+        digest.update(b">>")
+        if isinstance(obj, pikepdf.Stream):
+            digest.update(obj.read_raw_bytes())
+    elif isinstance(obj, pikepdf.Array):
+        digest.update(b"[")
+        for item in obj:
+            hash_object(item, digest, visited)
+        digest.update(b"]")
+    elif isinstance(obj, pikepdf.Object):
+        digest.update(obj.unparse())
+    else:
+        digest.update(repr(obj).encode())
+
+
+def inherited_value(page_obj, key):
+
+    """Effective value of a page attribute that can be inherited from the page tree
+
+    Args:
+        page_obj: page dictionary
+        key: attribute name, like /Rotate
+
+    Returns:
+        The value from the page or its nearest ancestor, None if none has it
+    """
+
+    node = page_obj
+    seen = set()
+    while node is not None and node.objgen not in seen:
+        if key in node:
+            return node.get(key)
+        seen.add(node.objgen)
+        node = node.get("/Parent")
+    return None
+
+
+# Page attributes inherited from the page tree, they change the page but not its own dictionary.
+inheritable_keys = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+
+def page_key(page, arguments):
+
+    """Cache key of the OCR result of a page
+
+    /Parent isn't followed, so the effective values of the inheritable
+    attributes are added to the key, a page rotated by its page tree gets
+    another key than the same page upright.
+
+    Args:
+        page: pikepdf page
+        arguments: argument parser
+
+    Returns:
+        Hex digest of the page content and the OCR settings
+    """
+
+    digest = hashlib.sha256(f"{ocrmypdf.__version__} {arguments.language} deskew".encode())
+    visited = {}
+    hash_object(page.obj, digest, visited)
+    for key in inheritable_keys:
+        value = inherited_value(page.obj, key)
+        if key == "/Rotate":
+            value = int(value or 0) % 360
+        digest.update(key.encode())
+        hash_object(value, digest, visited)
+    return digest.hexdigest()
+
+
+def ocr_shard(pdf, shard, keys, cache_dir, arguments):
+
+    """Run OCR on some pages of a document and cache every page
+
+    Args:
+        pdf: pikepdf document
+        shard: page numbers to do OCR on
+        keys: cache key of every page of the document
+        cache_dir: folder of the page cache
+        arguments: argument parser
+
+    Returns:
+        None
+    """
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        shard_input = os.path.join(temp_dir, "shard.pdf")
+        shard_output = os.path.join(temp_dir, "shard_ocr.pdf")
+
+        with pikepdf.Pdf.new() as shard_pdf:
+            for page_number in shard:
+                shard_pdf.pages.append(pdf.pages[page_number])
+            shard_pdf.save(shard_input)
+
+        ocrmypdf.ocr(shard_input, shard_output, language=arguments.language.split("+"), deskew=True,
+                     output_type="pdf", jobs=arguments.jobs, progress_bar=False)
+
+        # Write every page on its own, so later runs can reuse any of them.
+        with pikepdf.open(shard_output) as result:
+            for page_number, page in zip(shard, result.pages):
+                cache_file = os.path.join(cache_dir, keys[page_number] + ".pdf")
+                with pikepdf.Pdf.new() as single:
+                    single.pages.append(page)
+                    single.save(cache_file + ".tmp")
+                os.replace(cache_file + ".tmp", cache_file)
+
+
+# Page entries tied to the rest of the document, kept from the input page when the OCR'ed page is grafted on.
+document_page_keys = ("/Type", "/Parent", "/Annots", "/StructParents")
+
 
 def create_ocr(file, arguments):
 
     """Add OCR to document
 
+    Pages are OCR'ed in shards of --shard_size pages with --jobs
+    processes, and every OCR'ed page is cached by a hash of its content,
+    so running OCR again only processes new or changed pages.
+
     Args:
         file: file to work on
         arguments: argument parser
@@ -120,11 +928,44 @@ def create_ocr(file, arguments):
     if os.sep not in file:
         file = filepath
 
-    command = f"ocrmypdf -l {arguments.language} --deskew --output-type pdf {file} {file.replace('.pdf', '_ocr.pdf')}"
-     
-    res = os.system(command)
- 
-    print("Returned Value: ", res)
+    output = file.replace('.pdf', '_ocr.pdf')
+    cache_dir = arguments.ocr_cache or os.path.join(os.path.dirname(file), ".ocr_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with pikepdf.open(file) as pdf:
+        keys = [page_key(page, arguments) for page in pdf.pages]
+
+        # Identical pages only need OCR once.
+        missing = {}
+        for page_number, key in enumerate(keys):
+            if key not in missing and not os.path.exists(os.path.join(cache_dir, key + ".pdf")):
+                missing[key] = page_number
+        missing = list(missing.values())
+        print(f"OCR on {len(missing)} of {len(keys)} pages, the rest is cached")
+
+        for start in range(0, len(missing), arguments.shard_size):
+            shard = missing[start:start + arguments.shard_size]
+            print(f"OCR on pages {shard[0] + 1} to {shard[-1] + 1}")
+            ocr_shard(pdf, shard, keys, cache_dir, arguments)
+
+    # Put the OCR'ed pages together from the cache, then graft them onto the pages of the input, so its
+    # outline, page labels and document info stay.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ocr_pages = os.path.join(temp_dir, "pages.pdf")
+        merge_pdfs_streaming((os.path.join(cache_dir, key + ".pdf") for key in keys), ocr_pages)
+
+        with pikepdf.open(file) as pdf, pikepdf.open(ocr_pages) as ocr_pdf:
+            for page, ocr_page in zip(pdf.pages, ocr_pdf.pages):
+                ocr_page = pdf.copy_foreign(ocr_page.obj)
+                for key in list(page.obj.keys()):
+                    if key not in document_page_keys:
+                        del page.obj[key]
+                for key, value in ocr_page.items():
+                    if key not in document_page_keys:
+                        page.obj[key] = value
+            pdf.save(output)
+
+    print("Saved: ", output)
 
 
 if __name__ == "__main__":
@@ -133,7 +974,9 @@ if __name__ == "__main__":
 
     args = arg_parser()
 
-    if not args.ocr_only:
+    if args.batch or args.batch_list:
+        create_batch(args)
+    elif not args.ocr_only:
         create_pdf(args)
     elif args.ocr_only:
         create_ocr(args.inputs, args)
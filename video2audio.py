@@ -1,21 +1,147 @@
 import argparse
+import collections
+import concurrent.futures
+import glob
+import os
+import subprocess
 from moviepy import VideoFileClip
 
-def video_to_audio(input_path, output_path):
+video_types = (".mp4", ".mkv", ".mov", ".avi", ".webm", ".m4v", ".flv", ".wmv", ".ts")
+
+# Audio codecs (as named by ffprobe) each output container can hold without re-encoding.
+container_codecs = {
+    ".mp3": ("mp3",),
+    ".aac": ("aac",),
+    ".m4a": ("aac", "alac", "mp3"),
+    ".ogg": ("vorbis", "opus", "flac"),
+    ".opus": ("opus",),
+    ".flac": ("flac",),
+    ".wav": ("pcm_",),
+}
+
+
+def probe_audio_codec(input_path):
+    try:
+        p = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=codec_name",
+             "-of", "default=noprint_wrappers=1:nokey=1", input_path],
+            capture_output=True, text=True,
+        )
+    except FileNotFoundError:
+        return None
+    return p.stdout.strip() or None
+
+
+def can_copy(codec, output_path):
+    if codec is None:
+        return False
+    codecs = container_codecs.get(os.path.splitext(output_path)[1].lower(), ())
+    return any(codec == c or (c.endswith("_") and codec.startswith(c)) for c in codecs)
+
+
+def copy_audio(input_path, output_path):
+    subprocess.run(
+        ["ffmpeg", "-y", "-loglevel", "error", "-i", input_path, "-map", "0:a:0", "-vn", "-c:a", "copy", output_path],
+        check=True,
+    )
+
+
+def video_to_audio(input_path, output_path, copy=True):
+    # Fast path, copy the audio stream as it is when the container can hold it.
+    if copy and can_copy(probe_audio_codec(input_path), output_path):
+        try:
+            copy_audio(input_path, output_path)
+            return "stream copy"
+        except (FileNotFoundError, subprocess.CalledProcessError):
+            pass
+
     with VideoFileClip(input_path) as video:
         audio = video.audio
         if audio is None:
             raise ValueError("No audio stream found in the video.")
-        audio.write_audiofile(output_path)
+        audio.write_audiofile(output_path, logger=None)
+    return "re-encoded"
+
+
+def find_videos(pattern):
+    if os.path.isdir(pattern):
+        return sorted(
+            os.path.join(pattern, name) for name in os.listdir(pattern)
+            if name.lower().endswith(video_types) and os.path.isfile(os.path.join(pattern, name))
+        )
+    return sorted(path for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+
+def output_paths(inputs, output_dir, audio_format):
+    # Sub folders of the inputs are mirrored in the output directory.
+    base = os.path.commonpath([os.path.dirname(os.path.abspath(i)) for i in inputs]) if output_dir else None
+
+    def output_path(input_path, keep_ext):
+        name = os.path.basename(input_path) if keep_ext else os.path.splitext(os.path.basename(input_path))[0]
+        folder = os.path.dirname(input_path)
+        if output_dir:
+            folder = os.path.join(output_dir, os.path.relpath(os.path.dirname(os.path.abspath(input_path)), base))
+        return os.path.normpath(os.path.join(folder, f"{name}.{audio_format}"))
+
+    def key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    # Videos with the same name, like talk.mp4 and talk.mkv, keep their extension: talk.mp4.mp3.
+    outputs = [output_path(i, False) for i in inputs]
+    counts = collections.Counter(key(o) for o in outputs)
+    return [output_path(i, True) if counts[key(o)] > 1 else o for i, o in zip(inputs, outputs)]
+
+
+def batch_video_to_audio(inputs, output_dir, audio_format, copy=True, workers=None):
+    jobs = list(zip(inputs, output_paths(inputs, output_dir, audio_format)))
+
+    # Anything still writing the same file would overwrite each other on the pool.
+    counts = collections.Counter(os.path.normcase(os.path.abspath(o)) for _, o in jobs)
+    failed = [(i, o) for i, o in jobs if counts[os.path.normcase(os.path.abspath(o))] > 1]
+    for input_path, output_path in failed:
+        print(f"Error: {input_path}: {output_path} is also the output of another file")
+    jobs = [job for job in jobs if job not in failed]
+
+    for _, output_path in jobs:
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    failures = len(failed)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(video_to_audio, i, o, copy): (i, o) for i, o in jobs}
+        for future in concurrent.futures.as_completed(futures):
+            input_path, output_path = futures[future]
+            try:
+                print(f"Audio saved to {output_path} ({future.result()})")
+            except Exception as e:
+                failures += 1
+                print(f"Error: {input_path}: {e}")
+    print(f"{len(inputs) - failures} of {len(inputs)} files converted")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert video to audio (mp3).")
-    parser.add_argument("-i", "--input", required=True, help="Input video file path")
-    parser.add_argument("-o", "--output", default="output.mp3", help="Output audio file path (default: output.mp3)")
+    parser.add_argument("-i", "--input", required=True,
+                        help="Input video file path, or a directory or glob pattern for batch mode")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Output audio file path (default: output.mp3), "
+                             "or output directory in batch mode (default: next to each video)")
+    parser.add_argument("-f", "--format", default="mp3", help="Audio file type in batch mode (default: mp3)")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="Number of files converted at the same time in batch mode (default: all cores)")
+    parser.add_argument("--no-copy", action="store_true",
+                        help="Always re-encode, even when the audio stream could be copied as it is")
     args = parser.parse_args()
 
-    try:
-        video_to_audio(args.input, args.output)
-        print(f"Audio saved to {args.output}")
-    except Exception as e:
-        print(f"Error: {e}")
\ No newline at end of file
+    if os.path.isdir(args.input) or glob.has_magic(args.input):
+        inputs = find_videos(args.input)
+        if not inputs:
+            print(f"Error: no videos found in {args.input}")
+        else:
+            batch_video_to_audio(inputs, args.output, args.format.lstrip("."), not args.no_copy, args.workers)
+    else:
+        output = args.output or "output.mp3"
+        try:
+            method = video_to_audio(args.input, output, not args.no_copy)
+            print(f"Audio saved to {output} ({method})")
+        except Exception as e:
+            print(f"Error: {e}")
@@ -1,7 +1,18 @@
 import argparse
+import concurrent.futures
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 
 import cv2
+import numpy as np
 from tqdm import tqdm
 
 
@@ -39,19 +50,557 @@ def arg_parser():
         default=[1920, 1080],
         help="Desired video output resolution. e.g. 1920 1080",
     )
+    parser.add_argument(
+        "--interp",
+        type=str,
+        choices=["fast", "balanced", "quality", "auto"],
+        default="balanced",
+        help="Interpolation: fast is bilinear, balanced bicubic, quality Lanczos, "
+             "auto is area averaging for downscales and bicubic otherwise"
+    )
+    parser.add_argument(
+        "--aspect",
+        type=str,
+        choices=["stretch", "fit", "pad"],
+        default="stretch",
+        help="stretch to the resolution, fit inside it keeping the aspect ratio, or fit and pad with black to it"
+    )
+    parser.add_argument(
+        "--timing",
+        action="store_true",
+        help="Print per-frame timing of the decode, resize and encode stages"
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Reuse the previous scaled frame for frames that haven't changed"
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=int,
+        default=0,
+        help="Largest pixel difference for frames to count as unchanged"
+    )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of resize workers"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="Number of frames each pipeline queue holds"
+    )
+    parser.add_argument(
+        "--single-pass",
+        action="store_true",
+        help="Pipe the scaled frames into one ffmpeg process that also copies the source audio"
+    )
+    parser.add_argument(
+        "-p", "--processes",
+        type=int,
+        default=1,
+        help="Split the video at keyframes and scale the segments on this many processes"
+    )
+    parser.add_argument(
+        "--segment-time",
+        type=float,
+        default=60,
+        help="Target segment length in seconds with --processes, segments end at the next keyframe"
+    )
 
     print("\n" + str(parser.parse_args()) + "\n")
 
     return parser.parse_args()
 
 
-def scale_video(source_video_path, up_scaled_video_path, scaling_resolution):
+def print_ffmpeg_help():
+    """Print where to get ffmpeg and ffprobe.
+
+    Returns:
+
+    """
+    print("You will have to install ffprobe and ffmpeg to merge audio stream.")
+    print("Get them here: https://ffmpeg.org/download.html")
+    print("Install them to PATH or just place the binaries in the same folder as this script.")
+
+
+# Audio codecs (as named by ffprobe) each output container can hold without re-encoding,
+# names ending in _ match a family. Other audio is re-encoded to AAC.
+container_audio_codecs = {
+    ".mp4": ("aac", "mp3", "alac", "ac3", "eac3", "opus"),
+    ".m4v": ("aac", "mp3", "alac", "ac3", "eac3", "opus"),
+    ".mov": ("aac", "mp3", "alac", "ac3", "eac3", "pcm_"),
+    ".mkv": ("aac", "mp3", "alac", "ac3", "eac3", "opus", "vorbis", "flac", "dts", "truehd", "pcm_"),
+    ".webm": ("opus", "vorbis"),
+    ".avi": ("mp3", "ac3", "pcm_"),
+}
+
+
+def probe_audio_codec(source_video_path):
+    """Get the codec of the first audio stream of a video.
+
+    Args:
+        source_video_path: Path to the source video.
+
+    Returns:
+        Codec name as ffprobe reports it, None if there is no audio stream.
+    """
+    p = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "a:0", "-show_streams", "-print_format", "json",
+         source_video_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    streams = json.loads(p.stdout.decode("utf-8") or "{}").get("streams")
+    return streams[0].get("codec_name") if streams else None
+
+
+def audio_codec_args(source_video_path, up_scaled_video_path):
+    """ffmpeg options for the audio of the scaled video.
+
+    The audio is copied when the output container can hold its codec, and
+    re-encoded to AAC otherwise or when ffprobe is missing.
+
+    Args:
+        source_video_path: Path to the source video.
+        up_scaled_video_path: Path to the scaled video.
+
+    Returns:
+        List of ffmpeg options.
+    """
+    try:
+        codec = probe_audio_codec(source_video_path)
+    except FileNotFoundError:
+        codec = None
+    codecs = container_audio_codecs.get(os.path.splitext(up_scaled_video_path)[1].lower(), ())
+    if codec and any(codec == c or (c.endswith("_") and codec.startswith(c)) for c in codecs):
+        return ["-c:a", "copy"]
+    return ["-c:a", "aac"]
+
+
+class FfmpegWriter:
+    """Video writer piping raw frames into one ffmpeg process.
+
+    Has the write/release interface of cv2.VideoWriter. ffmpeg encodes the
+    frames and stream-copies the audio of the source video in the same run,
+    so nothing is written but the output. Audio the output container can't
+    hold is re-encoded to AAC.
+
+    Args:
+        source_video_path: Path to the source video, the audio is copied from it. None for no audio.
+        up_scaled_video_path: Path to the scaled video.
+        fps: Frame rate of the frames.
+        scaling_resolution: Tuple containing (width, height) of the frames.
+    """
+
+    def __init__(self, source_video_path, up_scaled_video_path, fps, scaling_resolution):
+        width, height = scaling_resolution
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", "%dx%d" % (width, height), "-r", str(fps), "-i", "-",
+        ]
+        if source_video_path is not None:
+            command += ["-i", source_video_path, "-map", "0:v:0", "-map", "1:a?"]
+            command += audio_codec_args(source_video_path, up_scaled_video_path)
+        command += ["-c:v", "libx264", "-pix_fmt", "yuv420p", up_scaled_video_path]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.data)
+
+    def release(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            # ffmpeg already exited, its exit code says why.
+            pass
+        if self.process.wait() != 0:
+            raise RuntimeError("ffmpeg failed with exit code %d" % self.process.returncode)
+
+
+def merge_audio(source_video_path, up_scaled_video_path):
+    """Copy the audio of the source video into the scaled video.
+
+    The streams are copied without re-encoding into a file next to the
+    scaled video, which then replaces it. Audio the output container can't
+    hold is re-encoded to AAC.
+
+    Args:
+        source_video_path: Path to the source video.
+        up_scaled_video_path: Path to the scaled video.
+
+    Returns:
+
+    """
+    try:
+        if probe_audio_codec(source_video_path) is None:
+            print("\nNo audio stream found.........\n")
+            return
+        print("\nMerging source audio and upscaled video.........\n")
+        root, ext = os.path.splitext(up_scaled_video_path)
+        merged_video_path = root + ".audio" + ext
+        subprocess.run(
+            [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-i", up_scaled_video_path,
+                "-i", source_video_path,
+                "-map", "0:v:0", "-map", "1:a",
+                "-c:v", "copy", *audio_codec_args(source_video_path, up_scaled_video_path),
+                merged_video_path,
+            ],
+            check=True,
+        )
+        os.replace(merged_video_path, up_scaled_video_path)
+    except Exception as e:
+        print(e)
+        print_ffmpeg_help()
+
+
+# Interpolation of the --interp choices, auto is picked per video by resize_plan.
+interpolations = {
+    "fast": cv2.INTER_LINEAR,
+    "balanced": cv2.INTER_CUBIC,
+    "quality": cv2.INTER_LANCZOS4,
+}
+
+
+def resize_plan(source_size, scaling_resolution, aspect="stretch", interp="balanced"):
+    """Work out how the frames of a video are resized.
+
+    Fitted sizes are rounded down to even numbers, which yuv420p needs.
+
+    Args:
+        source_size: Tuple containing (width, height) of the source video.
+        scaling_resolution: Tuple containing (width, height) of the desired resolution.
+        aspect: stretch, fit or pad.
+        interp: fast, balanced, quality or auto.
+
+    Returns:
+        Tuple of (scaled frame size, output frame size, (x, y) of the scaled frame in the output, cv2 interpolation).
+    """
+    width, height = scaling_resolution
+    source_width, source_height = source_size
+    if aspect == "stretch" or not source_width or not source_height:
+        scaled_size = (width, height)
+    else:
+        ratio = min(width / source_width, height / source_height)
+        scaled_size = (max(2, int(source_width * ratio) // 2 * 2), max(2, int(source_height * ratio) // 2 * 2))
+    output_size = scaled_size if aspect == "fit" else (width, height)
+    offset = ((output_size[0] - scaled_size[0]) // 2, (output_size[1] - scaled_size[1]) // 2)
+
+    if interp != "auto":
+        interpolation = interpolations[interp]
+    elif scaled_size[0] <= source_width and scaled_size[1] <= source_height:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_CUBIC
+    return scaled_size, output_size, offset, interpolation
+
+
+def make_buffers(plan, count):
+    """Preallocate the output frames the resize workers write into.
+
+    Buffers go round from the resize workers to the encoder and back, so
+    no frame is allocated while scaling. Padding stays black because only
+    the scaled area is ever written.
+
+    Args:
+        plan: Resize plan from resize_plan.
+        count: Number of buffers.
+
+    Returns:
+        Queue of buffers.
+    """
+    output_width, output_height = plan[1]
+    buffers = queue.Queue()
+    for _ in range(count):
+        buffers.put(np.zeros((output_height, output_width, 3), np.uint8))
+    return buffers
+
+
+def print_timing(timings):
+    """Print the per-frame timing of the pipeline stages.
+
+    Args:
+        timings: Dictionary of stage name to list of per-frame durations in seconds.
+
+    Returns:
+
+    """
+    print("\nPer-frame timing.........\n")
+    for stage, times in timings.items():
+        if not times:
+            continue
+        times = sorted(times)
+        mean = sum(times) / len(times)
+        print(
+            "%-7s %7d frames  mean %8.3f ms  median %8.3f ms  p95 %8.3f ms  %9.1f fps"
+            % (stage, len(times), mean * 1000, times[len(times) // 2] * 1000,
+               times[int(len(times) * 0.95)] * 1000, 1 / mean if mean else 0)
+        )
+
+
+def queue_put(q, item, stop):
+    """Put an item on a pipeline queue, giving up when the pipeline is stopped.
+
+    Args:
+        q: Queue.
+        item: Item to put.
+        stop: threading.Event set when the pipeline is stopped.
+
+    Returns:
+        True if the item was put, False if the pipeline was stopped.
+    """
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def queue_get(q, stop):
+    """Get an item from a pipeline queue, giving up when the pipeline is stopped.
+
+    Args:
+        q: Queue.
+        stop: threading.Event set when the pipeline is stopped.
+
+    Returns:
+        The item, or None if the pipeline was stopped.
+    """
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def decode_frames(source_video, frame_queue, workers, stop, timings=None, dedup_threshold=None):
+    """Decode stage, reads the frames of the source video into the frame queue.
+
+    With dedup_threshold, frames that match the last frame sent to be
+    scaled are sent as None, so the encoder repeats the previous scaled
+    frame. 1/8 size thumbnails are compared first, as a cheap way to find
+    changed frames. Averaging hides small changes like a cursor in them,
+    so frames with matching thumbnails are compared at full resolution.
+
+    Args:
+        source_video: cv2.VideoCapture of the source video.
+        frame_queue: Queue of (index, frame) for the resize workers.
+        workers: Number of resize workers, each gets a None when all frames are read, or the decode error.
+        stop: threading.Event set when the pipeline is stopped.
+        timings: Dictionary of per-frame durations, or None.
+        dedup_threshold: Largest pixel difference of unchanged frames, or None to scale every frame.
+
+    Returns:
+
+    """
+    end = None
+    try:
+        index = 0
+        previous = None
+        previous_frame = None
+        while True:
+            start = time.perf_counter()
+            ret, frame = source_video.read()
+            if not ret:
+                break
+            if timings is not None:
+                timings["decode"].append(time.perf_counter() - start)
+            if dedup_threshold is not None:
+                thumbnail = cv2.resize(
+                    frame, (max(1, frame.shape[1] // 8), max(1, frame.shape[0] // 8)), interpolation=cv2.INTER_AREA
+                )
+                # Compared with the last scaled frame, so slow changes can't add up unnoticed.
+                if (
+                    previous is not None
+                    and cv2.norm(thumbnail, previous, cv2.NORM_INF) <= dedup_threshold
+                    and cv2.norm(frame, previous_frame, cv2.NORM_INF) <= dedup_threshold
+                ):
+                    frame = None
+                else:
+                    previous = thumbnail
+                    previous_frame = frame
+            if not queue_put(frame_queue, (index, frame), stop):
+                return
+            index += 1
+    except Exception as e:
+        # Passed on through the resize workers, so the encoder raises it instead of ending the video early.
+        end = e
+    finally:
+        for _ in range(workers):
+            queue_put(frame_queue, end, stop)
+
+
+def resize_frames(frame_queue, scaled_queue, plan, buffers, stop, timings=None):
+    """Resize stage, scales frames from the frame queue into the scaled queue.
+
+    A buffer is taken before the frame, so the worker holding the frame the
+    encoder waits for always has one, however many wait in the encoder.
+
+    Args:
+        frame_queue: Queue of (index, frame) from the decoder.
+        scaled_queue: Queue of (index, scaled frame) for the encoder, gets a None when done.
+        plan: Resize plan from resize_plan.
+        buffers: Queue of preallocated output frames.
+        stop: threading.Event set when the pipeline is stopped.
+        timings: Dictionary of per-frame durations, or None.
+
+    Returns:
+
+    """
+    (scaled_width, scaled_height), _, (x, y), interpolation = plan
+    try:
+        while True:
+            b = queue_get(buffers, stop)
+            item = queue_get(frame_queue, stop) if b is not None else None
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            index, frame = item
+            if frame is None:
+                # Unchanged frame, the encoder repeats the previous one.
+                buffers.put(b)
+                queue_put(scaled_queue, (index, None), stop)
+                continue
+            start = time.perf_counter()
+            cv2.resize(
+                frame, (scaled_width, scaled_height), dst=b[y:y + scaled_height, x:x + scaled_width],
+                interpolation=interpolation
+            )
+            if timings is not None:
+                timings["resize"].append(time.perf_counter() - start)
+            queue_put(scaled_queue, (index, b), stop)
+    except Exception as e:
+        # The encoder raises it, a missing frame would stall the ordering.
+        queue_put(scaled_queue, e, stop)
+    else:
+        queue_put(scaled_queue, None, stop)
+
+
+def encode_frames(scaled_queue, scaled_video, workers, pbar, buffers, timings=None):
+    """Encode stage, writes the scaled frames in their original order.
+
+    Frames finished out of order wait in a dictionary until it's their turn.
+    It can't grow past the number of buffers. The last written frame is kept
+    out of the buffer pool, so unchanged frames can repeat it.
+
+    Args:
+        scaled_queue: Queue of (index, scaled frame) from the resize workers.
+        scaled_video: cv2.VideoWriter of the scaled video.
+        workers: Number of resize workers.
+        pbar: Progress bar.
+        buffers: Queue the written frames are given back to.
+        timings: Dictionary of per-frame durations, or None.
+
+    Returns:
+        Tuple of (number of frames written, number of unchanged frames repeated).
+    """
+    pending = {}
+    next_index = 0
+    finished = 0
+    last = None
+    duplicates = 0
+    while finished < workers:
+        item = scaled_queue.get()
+        if item is None:
+            finished += 1
+            continue
+        if isinstance(item, Exception):
+            raise item
+        index, b = item
+        pending[index] = b
+        while next_index in pending:
+            b = pending.pop(next_index)
+            if b is None:
+                b = last
+                duplicates += 1
+            start = time.perf_counter()
+            scaled_video.write(b)
+            if timings is not None:
+                timings["encode"].append(time.perf_counter() - start)
+            if b is not last:
+                if last is not None:
+                    buffers.put(last)
+                last = b
+            next_index += 1
+            pbar.update(1)
+    return next_index, duplicates
+
+
+def run_pipeline(source_video, scaled_video, plan, workers, queue_size, pbar, timings=None, dedup_threshold=None):
+    """Run the decode / resize / encode pipeline over a whole video.
+
+    Args:
+        source_video: cv2.VideoCapture of the source video.
+        scaled_video: Writer of the scaled video.
+        plan: Resize plan from resize_plan.
+        workers: Number of resize workers.
+        queue_size: Number of frames each pipeline queue holds.
+        pbar: Progress bar.
+        timings: Dictionary the per-frame durations of each stage are added to, or None.
+        dedup_threshold: Largest pixel difference of unchanged frames, or None to scale every frame.
+
+    Returns:
+        Tuple of (number of frames written, number of unchanged frames repeated).
+    """
+    stop = threading.Event()
+    frame_queue = queue.Queue(maxsize=queue_size)
+    scaled_queue = queue.Queue(maxsize=queue_size)
+    buffers = make_buffers(plan, queue_size + 2 * workers)
+    threads = [
+        threading.Thread(
+            target=decode_frames, args=(source_video, frame_queue, workers, stop, timings, dedup_threshold),
+            daemon=True
+        )
+    ]
+    threads += [
+        threading.Thread(
+            target=resize_frames, args=(frame_queue, scaled_queue, plan, buffers, stop, timings), daemon=True
+        )
+        for _ in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        return encode_frames(scaled_queue, scaled_video, workers, pbar, buffers, timings)
+    finally:
+        # On an error the other stages are blocked on full or empty queues, stopping lets them end.
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def scale_video(source_video_path, up_scaled_video_path, scaling_resolution, workers=1, queue_size=16,
+                single_pass=False, interp="balanced", aspect="stretch", timing=False, dedup_threshold=None):
     """Function to scale video.
 
+    Decoding, resizing and encoding run as a pipeline connected by bounded
+    queues, so the stages overlap. OpenCV releases the GIL, so threads are
+    enough to run them in parallel.
+
+    With single_pass the frames are piped into ffmpeg, which copies the
+    source audio in the same run. Otherwise OpenCV writes the video and the
+    audio is copied into it afterwards.
+
     Args:
         source_video_path: Path to the source video.
         up_scaled_video_path: Path to the scaled video.
         scaling_resolution: Tuple containing (width, height) of the desired resolution.
+        workers: Number of resize workers.
+        queue_size: Number of frames each pipeline queue holds.
+        single_pass: Encode with ffmpeg and copy the audio in the same run.
+        interp: Interpolation, fast, balanced, quality or auto.
+        aspect: stretch, fit or pad.
+        timing: Print per-frame timing of the stages.
+        dedup_threshold: Largest pixel difference of unchanged frames, or None to scale every frame.
 
     Returns:
 
@@ -61,63 +610,209 @@ def scale_video(source_video_path, up_scaled_video_path, scaling_resolution):
     dest_video = up_scaled_video_path
     source_fps = source_video.get(cv2.CAP_PROP_FPS)
     total_frames = int(source_video.get(cv2.CAP_PROP_FRAME_COUNT))
-    video_format = cv2.VideoWriter_fourcc(*"H264")
-    scaled_video = cv2.VideoWriter(
-        dest_video, video_format, source_fps, scaling_resolution
-    )
+    source_size = (int(source_video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(source_video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    plan = resize_plan(source_size, scaling_resolution, aspect, interp)
+    if single_pass:
+        try:
+            scaled_video = FfmpegWriter(source_video_path, dest_video, source_fps, plan[1])
+        except FileNotFoundError as e:
+            print(e)
+            print_ffmpeg_help()
+            source_video.release()
+            return
+    else:
+        video_format = cv2.VideoWriter_fourcc(*"H264")
+        scaled_video = cv2.VideoWriter(
+            dest_video, video_format, source_fps, plan[1]
+        )
     print("\nRescaling...........\n")
     pbar = tqdm(total=total_frames)
-    while True:
-        ret, frame = source_video.read()
-        if ret:
-            b = cv2.resize(
-                frame, scaling_resolution, fx=0, fy=0, interpolation=cv2.INTER_CUBIC
-            )
-            scaled_video.write(b)
-            pbar.update(1)
-        else:
-            pbar.close()
-            break
+    timings = {"decode": [], "resize": [], "encode": []} if timing else None
+    try:
+        _, duplicates = run_pipeline(
+            source_video, scaled_video, plan, workers, queue_size, pbar, timings, dedup_threshold
+        )
+    finally:
+        pbar.close()
+        source_video.release()
+        scaled_video.release()
+    if dedup_threshold is not None:
+        print("\nSkipped resizing %d unchanged frames.........\n" % duplicates)
+    if timing:
+        print_timing(timings)
+    if not single_pass:
+        merge_audio(source_video_path, dest_video)
+
+
+class QueueProgress:
+    """Progress bar stand-in for segment workers, sends frame counts to the main process.
+
+    Counts are sent in batches to keep the inter-process traffic down.
+
+    Args:
+        progress_queue: Manager queue read by the main process.
+        batch: Number of frames per message.
+    """
+
+    def __init__(self, progress_queue, batch=25):
+        self.progress_queue = progress_queue
+        self.batch = batch
+        self.count = 0
+
+    def update(self, n=1):
+        self.count += n
+        if self.count >= self.batch:
+            self.progress_queue.put(self.count)
+            self.count = 0
+
+    def close(self):
+        if self.count:
+            self.progress_queue.put(self.count)
+            self.count = 0
+
+
+def scale_segment(segment_path, scaled_segment_path, plan, fps, workers, queue_size, progress_queue, timing=False,
+                  dedup_threshold=None):
+    """Scale one segment of a video, run on a worker process.
+
+    Args:
+        segment_path: Path to the source segment.
+        scaled_segment_path: Path to the scaled segment.
+        plan: Resize plan from resize_plan.
+        fps: Frame rate of the source video.
+        workers: Number of resize workers.
+        queue_size: Number of frames each pipeline queue holds.
+        progress_queue: Manager queue the number of scaled frames is sent to.
+        timing: Collect per-frame timing of the stages.
+        dedup_threshold: Largest pixel difference of unchanged frames, or None to scale every frame.
+
+    Returns:
+        Tuple of (number of unchanged frames repeated, dictionary of per-frame durations of each stage or None).
+    """
+    source_video = cv2.VideoCapture(segment_path)
+    scaled_video = FfmpegWriter(None, scaled_segment_path, fps, plan[1])
+    pbar = QueueProgress(progress_queue)
+    timings = {"decode": [], "resize": [], "encode": []} if timing else None
+    try:
+        _, duplicates = run_pipeline(
+            source_video, scaled_video, plan, workers, queue_size, pbar, timings, dedup_threshold
+        )
+        return duplicates, timings
+    finally:
+        pbar.close()
+        source_video.release()
+        scaled_video.release()
+
+
+def scale_video_segments(source_video_path, up_scaled_video_path, scaling_resolution, processes, workers=1,
+                         queue_size=16, segment_time=60, interp="balanced", aspect="stretch", timing=False,
+                         dedup_threshold=None):
+    """Function to scale video in segments on a process pool.
+
+    The video stream is split with stream copy, which can only cut at
+    keyframes, so the segments start at the first keyframe after every
+    segment_time seconds. The scaled segments are joined with the concat
+    demuxer and the source audio is copied in the same run, both without
+    re-encoding, unless the output container can't hold the audio codec.
+
+    Args:
+        source_video_path: Path to the source video.
+        up_scaled_video_path: Path to the scaled video.
+        scaling_resolution: Tuple containing (width, height) of the desired resolution.
+        processes: Number of segments scaled at the same time.
+        workers: Number of resize workers per process.
+        queue_size: Number of frames each pipeline queue holds.
+        segment_time: Target segment length in seconds.
+        interp: Interpolation, fast, balanced, quality or auto.
+        aspect: stretch, fit or pad.
+        timing: Print per-frame timing of the stages.
+        dedup_threshold: Largest pixel difference of unchanged frames, or None to scale every frame.
+
+    Returns:
+
+    """
+    source_video = cv2.VideoCapture(source_video_path)
+    source_fps = source_video.get(cv2.CAP_PROP_FPS)
+    total_frames = int(source_video.get(cv2.CAP_PROP_FRAME_COUNT))
+    source_size = (int(source_video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(source_video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    plan = resize_plan(source_size, scaling_resolution, aspect, interp)
     source_video.release()
-    scaled_video.release()
-    cv2.destroyAllWindows()
+
+    temp_dir = tempfile.mkdtemp(prefix="videoupscaler_", dir=os.path.dirname(os.path.abspath(up_scaled_video_path)))
     try:
-        p = subprocess.Popen(
-            ["ffprobe", "-show_streams", "-print_format", "json", source_video_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+        print("\nSplitting at keyframes...........\n")
+        subprocess.run(
+            [
+                "ffmpeg", "-loglevel", "error", "-i", source_video_path,
+                "-map", "0:v:0", "-c", "copy",
+                "-f", "segment", "-segment_time", str(segment_time), "-reset_timestamps", "1",
+                os.path.join(temp_dir, "segment%05d.mkv"),
+            ],
+            check=True,
         )
-        streams = p.communicate()[0]
-        streams = streams.decode("utf-8")
-        if "audio" in streams.lower():
-            print("\nExtracting audio from source video.........\n")
-            subprocess.call(["ffmpeg", "-i", source_video_path, "sourceaudio.mp3"])
-            print("\nMerging source audio and upscaled video.........\n")
-            subprocess.call(
-                [
-                    "ffmpeg",
-                    "-i",
-                    dest_video,
-                    "-i",
-                    "sourceaudio.mp3",
-                    "-map",
-                    "0:0",
-                    "-map",
-                    "1:0",
-                    up_scaled_video_path,
-                ]
-            )
-    except Exception as e:
+        segments = sorted(glob.glob(os.path.join(temp_dir, "segment*.mkv")))
+        scaled_segments = [os.path.join(temp_dir, "scaled%05d.mkv" % i) for i in range(len(segments))]
+
+        print("\nRescaling %d segments...........\n" % len(segments))
+        pbar = tqdm(total=total_frames)
+        with multiprocessing.Manager() as manager, \
+                concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            progress_queue = manager.Queue()
+            futures = [
+                executor.submit(scale_segment, segment, scaled_segment, plan, source_fps, workers,
+                                queue_size, progress_queue, timing, dedup_threshold)
+                for segment, scaled_segment in zip(segments, scaled_segments)
+            ]
+            not_done = futures
+            while not_done:
+                _, not_done = concurrent.futures.wait(not_done, timeout=0.2)
+                while not progress_queue.empty():
+                    pbar.update(progress_queue.get())
+            pbar.close()
+            timings = {"decode": [], "resize": [], "encode": []}
+            duplicates = 0
+            for future in futures:
+                segment_duplicates, segment_timings = future.result()
+                duplicates += segment_duplicates
+                for stage, times in (segment_timings or {}).items():
+                    timings[stage] += times
+
+        print("\nJoining segments and source audio...........\n")
+        concat_list = os.path.join(temp_dir, "segments.txt")
+        with open(concat_list, "w", encoding="utf-8") as f:
+            for scaled_segment in scaled_segments:
+                f.write("file '%s'\n" % scaled_segment.replace("'", "'\\''"))
+        subprocess.run(
+            [
+                "ffmpeg", "-y", "-loglevel", "error",
+                "-f", "concat", "-safe", "0", "-i", concat_list,
+                "-i", source_video_path,
+                "-map", "0:v:0", "-map", "1:a?",
+                "-c:v", "copy", *audio_codec_args(source_video_path, up_scaled_video_path),
+                up_scaled_video_path,
+            ],
+            check=True,
+        )
+        if dedup_threshold is not None:
+            print("\nSkipped resizing %d unchanged frames.........\n" % duplicates)
+        if timing:
+            print_timing(timings)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
         print(e)
-        print("You will have to install ffprobe and ffmpeg to merge audio stream.")
-        print("Get them here: https://ffmpeg.org/download.html")
-        print("Install them to PATH or just place the binaries in the same folder as this script.")
-    else:
-        print("\nNo audio stream found.........\n")
+        print_ffmpeg_help()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
 
 if __name__ == '__main__':
 
     args = arg_parser()
+    dedup_threshold = args.dedup_threshold if args.dedup else None
 
-    scale_video(args.input, args.output, tuple(args.resolution))
\ No newline at end of file
+    if args.processes > 1:
+        scale_video_segments(args.input, args.output, tuple(args.resolution), args.processes,
+                             max(1, args.workers // args.processes), args.queue_size, args.segment_time,
+                             args.interp, args.aspect, args.timing, dedup_threshold)
+    else:
+        scale_video(args.input, args.output, tuple(args.resolution), max(1, args.workers), args.queue_size,
+                    args.single_pass, args.interp, args.aspect, args.timing, dedup_threshold)
\ No newline at end of file